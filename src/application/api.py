@@ -14,8 +14,9 @@ from google.appengine.ext.db import Key
 from flask import jsonify, request, abort, Response
 from app import app
 import settings
-from report_types import ReportType, CSVReportType, KMLReportType
+from report_types import ReportType, CSVReportType, KMLReportType, export_etag
 from kml import path_to_kml
+from polygons import polygon_hash, polygon_stats as cached_polygon_stats
 
 from models import Area, Note, Report, StatsStore, FustionTablesNames
 from ee_bridge import NDFI, EELandsat, Stats, get_prodes_stats
@@ -60,28 +61,38 @@ def stats(table, zone=None, format="csv"):
         logging.error("bad format for report id")
         abort(400)
     
-    this_report = ReportType.factory(format)
-    this_report.init(zone)
-    this_report.write_header()
+    this_report = ReportType.factory(format, zone)
 
     logging.info("table id is %s ", table) 
     logging.info("and we see %s ", FustionTablesNames.all().filter('table_id =', table).fetch(1))
     logging.info("and zone %s ", zone)
     logging.info("and format %s ", format)
 
-    reports = [Report.get_by_id(x) for x in reports]
+    reports = Report.get_by_id(reports)
     for r in reports:
         if not r:
             logging.error("report not found")
             abort(404)
-        
-        stats = this_report.get_stats(r, table)
 
-        for s in stats:
-            this_report.write_row(r, s, table)
+    # the export changes when the stats of a report or the region names do
+    stores = StatsStore.get_for_reports([str(r.key()) for r in reports])
+    versions = [s and s.updated for s in stores]
+    etag = export_etag('stats', str(table), format, zone, [r.key().id() for r in reports],
+                       versions, FustionTablesNames.version())
+    last_modified = max([v for v in versions if v] or [None])
 
-    this_report.write_footer()
-    return this_report.response("report_%s" % table)
+    def render():
+        report_stats = [(r, this_report.get_stats(r, table)) for r in reports]
+
+        def rows():
+            # load every region the export needs at once, once the header is out
+            this_report.prefetch(table, [s['id'] for r, stats in report_stats for s in stats])
+            for r, stats in report_stats:
+                for s in stats:
+                    yield (r, s, table)
+        return this_report.generate(rows())
+
+    return this_report.cached_response(etag, last_modified, render, "report_%s" % table)
 
 
 @app.route('/api/v0/stats/polygon/<format>')
@@ -101,28 +112,34 @@ def polygon_stats(format=None):
         logging.error("can't find some report")
         abort(404)
 
-    #TODO: test if polygon is ccw
     # exchange lat, lon -> lon, lat
     polygon = json.loads(request.args.get('polygon', None))
     polygon.append(polygon[0])
     if not polygon:
         abort(404)
-    ee = Stats()
+    this_report = ReportType.factory(format, "custom polygon")
+
     normalized_poly = [(coord[1], coord[0]) for coord in polygon]
-    stats = ee.get_stats_for_polygon([(str(r.key().id()), r.assetid) for r in reports], [normalized_poly])
 
-    this_report = ReportType.factory(format)
-    this_report.init("custom polygon")
-    try:
-        this_report.write_header()
-        for i,s in enumerate(stats):
-            r = reports[i]
-            this_report.write_row(r, s, None, path_to_kml([polygon]))
-
-        this_report.write_footer()
-        return this_report.response("report_polygon")
-    except (KeyError, ValueError, IndexError):
-        abort(404)
+    def render():
+        stats = cached_polygon_stats(Stats(), reports, normalized_poly)
+        if stats is None:
+            abort(404)
+        try:
+            # one row per report, written before answering so bad stats are a 404
+            rows = [(reports[i], s, None, path_to_kml([polygon])) for i, s in enumerate(stats)]
+            return list(this_report.generate(rows))
+        except (KeyError, ValueError, IndexError):
+            abort(404)
+
+    if reports and all(r and r.finished for r in reports):
+        # closed reports never change, so neither does their export
+        etag = export_etag('polygon', format, polygon_hash(normalized_poly),
+                           [(r.key().id(), r.assetid) for r in reports])
+        ends = [r.end for r in reports if r.end]
+        last_modified = datetime(*max(ends).timetuple()[:3]) if ends else None
+        return this_report.cached_response(etag, last_modified, render, "report_polygon")
+    return this_report.response(render(), "report_polygon")
 
 def landstat():
     e = EELandsat()
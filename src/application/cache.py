@@ -0,0 +1,149 @@
+"""
+cache.py
+
+In-process and memcache backed caches
+
+"""
+
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+    """ thread safe in-process cache which evicts least recently used entries """
+
+    def __init__(self, max_items=1000):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            # move to the most recently used end
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SizedLRUCache(LRUCache):
+    """ LRU cache bounded by the total size of its values, as measured
+        by ``sizeof``, instead of by the number of items
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        super(SizedLRUCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self._items[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                k, v = self._items.popitem(last=False)
+                self.size -= self.sizeof(v)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class TwoTierCache(object):
+    """ in-process LRU cache backed by memcache
+
+        ``namespace`` isolates the memcache keys of each cache and ``time``
+        is the memcache expiration in seconds (0 means no expiration).
+        With ``max_bytes`` the in-process cache is bounded by the total
+        length of its values instead of by ``max_items``
+    """
+
+    def __init__(self, namespace, max_items=1000, time=0, max_bytes=None):
+        self.namespace = namespace
+        self.time = time
+        if max_bytes:
+            self.local = SizedLRUCache(max_bytes)
+        else:
+            self.local = LRUCache(max_items)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = memcache.get(str(key), namespace=self.namespace)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def get_multi(self, keys):
+        """ return a dict with the cached values of keys, reading the ones
+            missing in this instance with a single memcache call
+        """
+        values = {}
+        missing = {}
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing[str(key)] = key
+            else:
+                values[key] = value
+        if missing:
+            found = memcache.get_multi(missing.keys(), namespace=self.namespace)
+            for k, value in found.iteritems():
+                self.local.set(missing[k], value)
+                values[missing[k]] = value
+        return values
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        memcache.set(str(key), value, time=self.time, namespace=self.namespace)
+
+    def delete(self, key):
+        self.local.delete(key)
+        memcache.delete(str(key), namespace=self.namespace)
+
+    def get_or_compute(self, key, compute):
+        """ return cached value for key, calling ``compute()`` on a miss """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
@@ -2,6 +2,7 @@
 
 import logging
 import random
+import re
 import simplejson as json
 import time
 from datetime import datetime, date
@@ -11,14 +12,16 @@ from application.time_utils import timestamp
 from google.appengine.ext import deferred
 from google.appengine.ext.db import Key
 from google.appengine.api import memcache
+from google.appengine.runtime.apiproxy_errors import OverQuotaError
 
 from application import settings
 from ft import FT
 
 from time_utils import month_range
-from application.models import Report, Cell, StatsStore, FustionTablesNames
-from application.constants import amazon_bounds
+from application.models import Report, Cell, CellWriter, CellCounter, StatsStore, StatsTable, FustionTablesNames, StatsRegionChange, record_region_changes
+from application.constants import amazon_bounds, tables
 from ee_bridge import NDFI
+from concurrency import TokenBucket, run_parallel
 
 
 @app.route('/_ah/cmd/create_table')
@@ -64,7 +67,7 @@ def show_tables():
     if not month or not year:
         abort(400)
     start = date(year=int(year), month=int(month), day=int(day))
-    r = Report(start=start, finished=False)
+    r = Report(start=start, finished=False, keyed_cells=True, cell_counters=True)
     r.put()
 
     assetid = request.args.get('assetid', '')
@@ -86,8 +89,12 @@ def show_tables():
 def update_cells_ndfi():
     r = Report.current()
     cell = Cell.get_or_default(r, 0, 0, 0)
-    for c in iter(cell.children()):
-        c.put()
+    children = cell.children()
+    writer = CellWriter()
+    for c in children:
+        writer.add(c)
+    writer.commit()
+    for c in children:
         deferred.defer(ndfi_value_for_cells, str(c.key()), _queue="ndfichangevalue")
     return 'working'
 
@@ -117,6 +124,9 @@ def ndfi_value_for_cells(cell_key):
         logging.error("can't get ndfi change value")
         return
     ndfi = data['properties']['ndfiSum']['values']
+    children = Cell.get_or_default_many(cell.report,
+        [cell.child_pos(row, col) for row in xrange(10) for col in xrange(10)])
+    writer = CellWriter()
     for row in xrange(10):
         for col in xrange(10):
             idx = row*10 + col
@@ -129,9 +139,10 @@ def ndfi_value_for_cells(cell_key):
             ratio = ratio/10.0 #10 value is experimental
             # asign to cell
             logging.info('cell ndfi (%d, %d): %f' % (row, col, ratio))
-            c = cell.child(row, col)
+            c = children[idx]
             c.ndfi_change_value = ratio
-            c.put()
+            writer.add(c)
+    writer.commit()
 
     #cell.calculate_ndfi_change_from_childs()
 
@@ -143,8 +154,12 @@ def update_cells_ndfi_dummy():
     if not r:
         return 'create a report first'
     cell = Cell.get_or_default(r, 0, 0, 0)
-    for c in iter(cell.children()):
-        c.put()
+    children = cell.children()
+    writer = CellWriter()
+    for c in children:
+        writer.add(c)
+    writer.commit()
+    for c in children:
         deferred.defer(ndfi_value_for_cells_dummy, str(c.key()), _queue="ndfichangevalue")
     return 'working DUMMY'
 
@@ -156,24 +171,17 @@ def ndfi_value_for_cells_dummy(cell_key):
     ne = bounds[0]
     sw = bounds[1]
     polygons = [[ sw, (sw[0], ne[1]), ne, (ne[0], sw[1]) ]]
-    for row in xrange(10):
-        for col in xrange(10):
-            c = cell.child(row, col)
-            c.ndfi_change_value = random.random()
-            c.put()
+    children = Cell.get_or_default_many(cell.report,
+        [cell.child_pos(row, col) for row in xrange(10) for col in xrange(10)])
+    writer = CellWriter()
+    for c in children:
+        c.ndfi_change_value = random.random()
+        writer.add(c)
+    writer.commit()
 
     cell.calculate_ndfi_change_from_childs()
 
 
-tables = [
-    ('Municipalities', 1560866, 'name'),
-    ('States', 1560836, 'name'),
-    ('Federal Conservation', 1568452, 'ex_area'),
-    ('State Conservation', 2042133, 'name'),
-    ('Ingienous Land',1630610, 'name'),
-    ('Legal Amazon', 1205151, 'name')
-]
-
 tables_map = dict(x[:2] for x in tables)
 
 #
@@ -183,7 +191,10 @@ tables_map = dict(x[:2] for x in tables)
 from application.ee_bridge import Stats
 @app.route('/_ah/cmd/update_report_stats/<report_id>', methods=('GET',))
 def update_report_stats_view(report_id):
-    deferred.defer(update_report_stats, report_id)
+    if request.args.get('incremental', ''):
+        deferred.defer(update_report_stats_incremental, report_id)
+    else:
+        deferred.defer(update_report_stats, report_id)
     return 'updating'
 
 @app.route('/_ah/cmd/update_stats', methods=('GET',))
@@ -197,37 +208,99 @@ def update_report_global_stats(report_id):
     deferred.defer(update_total_stats_for_report, report_id)
     return 'updating'
 
-def stats_for(report_id, assetid, table):
+# the column the zones of each table are read from, see record_region_changes
+zone_columns = dict((table, name) for desc, table, name in tables)
+
+def stats_for(report_id, assetid, table, zones=None):
     ee = Stats()
-    return ee.get_stats(report_id, assetid,  table)
+    return ee.get_stats(report_id, assetid,  table, zones, zone_columns.get(table, 'name'))
+
+# shared by every stats computation running on this instance so region
+# tables are not read from FT faster than it allows
+stats_limiter = TokenBucket(settings.STATS_CALLS_PER_SECOND, settings.STATS_CONCURRENCY)
+
+# HTTP statuses and messages EE and FT answer with when asked to slow down
+THROTTLED_STATUSES = (429, 503)
+THROTTLED_MESSAGE = re.compile(r'\bHTTP code: (429|503)\b'
+                               r'|\btoo many (concurrent|requests)\b'
+                               r'|\b(quota|rate limit) exceeded\b'
+                               r'|\bover quota\b', re.I)
+
+def is_throttled(error):
+    """ whether ``error`` asks to retry later rather than being a failure
+        of the call itself """
+    if isinstance(error, OverQuotaError):
+        return True
+    if getattr(error, 'code', None) in THROTTLED_STATUSES:
+        return True
+    return THROTTLED_MESSAGE.search(str(error)) is not None
+
+def stats_for_tables(r, stats, tables_zones):
+    """ compute stats for ``tables_zones``, a list of (table, zones) pairs,
+        in parallel and add them to ``stats``. zones can be None for all the rows
+    """
+    report_id = str(r.key().id())
+    def call(table, zones):
+        return lambda: stats_for(report_id, r.assetid, table, zones)
+    results = run_parallel([(table, call(table, zones)) for table, zones in tables_zones],
+                           concurrency=settings.STATS_CONCURRENCY,
+                           limiter=stats_limiter,
+                           retries=settings.STATS_RETRIES,
+                           retry_on=is_throttled)
+    for res in results:
+        logging.info("stats for table %s: %.1fs, %d attempts" % (res.name, res.elapsed, res.attempts))
+        if res.error:
+            # let the task queue retry the whole report
+            raise res.error
+        stats['stats'].update(res.value)
 
 def update_report_stats(report_id):
     r = Report.get(Key(report_id))
+    # pending polygon edits are covered by the full recompute
+    changes = StatsRegionChange.for_report(report_id)
     stats = {
         'id': report_id,
         'stats': {}
     }
-    for desc, table, name in tables:
-        stats['stats'].update(stats_for(str(r.key().id()), r.assetid, table))
-        # sleep for some time to avoid problems with FT 
-        time.sleep(4)
+    stats_for_tables(r, stats, [(table, None) for desc, table, name in tables])
 
-    data = json.dumps(stats)
+    save_report_stats(report_id, stats)
+    for c in changes:
+        StatsRegionChange.remove(report_id, c.table, c.zones)
+
+def update_report_stats_incremental(report_id):
+    """ recompute stats only for the region rows touched by polygon edits
+        (see StatsRegionChange) and patch them into the stored stats. A
+        report without stored stats gets them all computed
+    """
+    r = Report.get(Key(report_id))
+    # edits not looked up by their own task yet
+    record_region_changes(report_id)
+    changes = StatsRegionChange.for_report(report_id)
     s = StatsStore.get_for_report(report_id)
-    if s:
-        s.json = data
-        s.put()
-    else:
-        StatsStore(report_id=report_id, json=data).put()
-    # wait a little bit to allow app store saves the data
-    time.sleep(1.0)
+    if not s:
+        # the zones edited so far do not tell which rows the stats are
+        # missing for, so they all have to be computed
+        update_report_stats(report_id)
+        return
+    stats = s.as_dict()
+    # written by earlier versions, not part of the stats
+    stats.pop('timings', None)
+    stats_for_tables(r, stats, [(int(c.table), c.zones) for c in changes])
+
+    save_report_stats(report_id, stats)
+    for c in changes:
+        StatsRegionChange.remove(report_id, c.table, c.zones)
+
+def save_report_stats(report_id, stats):
+    StatsStore.save_for_report(report_id, stats)
     update_total_stats_for_report(report_id)
 
 def update_total_stats_for_report(report_id):
     r = Report.get(Key(report_id))
-    stats = StatsStore.get_for_report(report_id)
+    stats = StatsTable.for_report(report_id, tables_map['Legal Amazon'])
     if stats:
-        s = stats.table_accum(tables_map['Legal Amazon'])[0]
+        s = stats.accum()[0]
         logging.info("stats for %s" % s)
         if s:
             r.degradation = s['deg']
@@ -237,6 +310,21 @@ def update_total_stats_for_report(report_id):
         logging.error("can't find stats for %s" % report_id)
 
 
+@app.route('/_ah/cmd/migrate_stats')
+def migrate_stats():
+    """ store stats saved in the old single document format by table """
+    for x in StatsStore.all():
+        if not x.key().name():
+            StatsStore.save_for_report(x.report_id, x.as_dict())
+    return "migrated"
+
+@app.route('/_ah/cmd/recount_cells/<report_id>')
+def recount_cells(report_id):
+    """ build the cell counters of a report created before they existed """
+    r = Report.get(Key(report_id))
+    deferred.defer(CellCounter.recount, r)
+    return "recounting"
+
 @app.route('/_ah/cmd/flush_all')
 def flush_all():
     memcache.flush_all()
@@ -268,4 +356,5 @@ def fusion_tables_names():
 
         FustionTablesNames(table_id=str(table), json=json.dumps(dict(data))).put()
 
+    FustionTablesNames.new_version()
     return "working"
@@ -0,0 +1,96 @@
+"""
+concurrency.py
+
+Helpers to run independent, rate limited calls in parallel
+
+"""
+
+import logging
+import threading
+import time
+from Queue import Queue
+
+
+class TokenBucket(object):
+    """ thread safe rate limiter, hands out ``rate`` tokens per second
+        allowing bursts of up to ``capacity`` tokens
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ block until a token is available and take it """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CallResult(object):
+    """ outcome of a call run by run_parallel """
+
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+        self.error = None
+        self.elapsed = 0.0
+        self.attempts = 0
+
+
+def run_parallel(calls, concurrency=4, limiter=None, retries=0, backoff=1.0, retry_on=None):
+    """ run ``calls``, a list of (name, callable) pairs, on up to
+        ``concurrency`` threads
+
+        each attempt takes a token from ``limiter`` (a TokenBucket) if given.
+        Failed calls for which ``retry_on(error)`` is true are retried up to
+        ``retries`` times waiting ``backoff`` seconds, doubled on each retry.
+        Return a list of CallResult in the same order as calls
+    """
+    results = [CallResult(name) for name, fn in calls]
+    pending = Queue()
+    for i, call in enumerate(calls):
+        pending.put((i, call[1]))
+
+    def worker():
+        while True:
+            try:
+                i, fn = pending.get_nowait()
+            except Exception:
+                return
+            res = results[i]
+            start = time.time()
+            while True:
+                if limiter:
+                    limiter.acquire()
+                res.attempts += 1
+                try:
+                    res.value = fn()
+                    res.error = None
+                    break
+                except Exception, e:
+                    res.error = e
+                    if res.attempts > retries or not (retry_on and retry_on(e)):
+                        logging.error("%s failed: %s" % (res.name, e))
+                        break
+                    wait = backoff * 2 ** (res.attempts - 1)
+                    logging.warning("%s throttled, retrying in %.1fs: %s" % (res.name, wait, e))
+                    time.sleep(wait)
+            res.elapsed = time.time() - start
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(concurrency, len(calls)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
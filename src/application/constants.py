@@ -3,3 +3,29 @@ amazon_bounds = (
         (5.462895560209557, -43.43994140625),
         (-18.47960905583197, -74.0478515625)
 )
+
+# region tables stats are computed for: (description, fusion table id, name column)
+tables = [
+    ('Municipalities', 1560866, 'name'),
+    ('States', 1560836, 'name'),
+    ('Federal Conservation', 1568452, 'ex_area'),
+    ('State Conservation', 2042133, 'name'),
+    ('Ingienous Land',1630610, 'name'),
+    ('Legal Amazon', 1205151, 'name')
+]
+
+
+def zone_id(value):
+    """ id of a region row as stats keep it, from the value of its name
+        column. FT and EE return numeric columns as floats, so 12 and 12.0
+        are the same row
+    """
+    if not isinstance(value, basestring):
+        value = str(value)
+    try:
+        number = float(value)
+        if number == int(number):
+            return str(int(number))
+    except ValueError:
+        pass
+    return value
@@ -12,11 +12,22 @@
 
 import collections
 import datetime
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import os
 import re
+import threading
 import time
+import zlib
 
 import ee
 import settings
+from cache import LRUCache, TwoTierCache
+from constants import zone_id
+from google.appengine.api import memcache
 
 # A multiplier to convert square meters to square kilometers.
 METER2_TO_KM2 = 1.0/(1000*1000)
@@ -42,6 +53,9 @@ INVALID_NDFI = MAX_NDFI + 1
 # The length of a "long" time period in milliseconds.
 LONG_SPAN_SIZE_MS = 1000 * 60 * 60 * 24 * 30 * 9
 
+# The length of a day in milliseconds.
+DAY_MS = 1000 * 60 * 60 * 24
+
 # MODIS projection specification.
 MODIS_CRS = 'SR-ORG:6974'
 MODIS_WIDTH = 20015100
@@ -57,12 +71,138 @@ MODIS_INCLUSIONS_TABLE = 'ft:1zqKClXoaHjUovWSydYDfOvwsrLVw-aNU4rh3wLc'
 # The ID of the Fusion Table containing kriging parameters.
 KRIGING_PARAMS_TABLE = 'ft:17Qn-29xy2JwFFeBam5YL_EjsvWo40zxkkOEq1Eo'
 
+# Metadata (class names and projections) of EE assets, keyed by asset ID.
+# An asset never changes once created, so entries never expire.
+_asset_metadata = TwoTierCache('asset_metadata', max_items=500)
+
+# Expression graphs built by the NDFI helper, and their serialized JSON once
+# needed, keyed by product, periods and arguments. Building a graph does not
+# call the EE server, so an entry never goes stale. Period ends are truncated
+# to the day in the key, so the graphs of an open report, which ends now, are
+# reused for the rest of the day.
+_graphs = LRUCache(max_items=200)
+
+# Mean and standard deviation of the bands rgb_stretch samples, keyed by
+# sensor, period (its end truncated to the day), mosaic version, bounding box
+# and band. The landsat mosaic version changes every day, so entries are kept
+# for as long.
+_stretch_stats = TwoTierCache('stretch_stats', max_items=1000, time=60 * 60 * 24)
+
+# Snapshots of the EE algorithm signatures shipped with the app, written by
+# tools/ee_signatures.py for each EE library version and API server.
+SIGNATURES_DIR = os.path.join(os.path.dirname(__file__), 'ee_signatures')
+
+_initialized = False
+_initialize_lock = threading.Lock()
+
+
+def initialize():
+    """Initializes the EE library on first use.
+
+    The algorithm signatures are read from memcache or from the snapshot
+    shipped for the EE library version, and only fetched from the server
+    when neither has them. Threads calling it meanwhile wait until the
+    library is ready.
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _initialize_lock:
+        if not _initialized:
+            ee.Initialize(settings.EE_CREDENTIALS, settings.EE_API_URL, _load_signatures())
+            _initialized = True
+
+
+def signatures_path(api_url):
+    """Returns the path of the signatures snapshot for an API server."""
+    host = re.sub('^https?://', '', api_url)
+    return os.path.join(SIGNATURES_DIR, '%s-%s.json.gz' % (ee.__version__, host))
+
+
+def _load_signatures():
+    """Returns the EE algorithm signatures."""
+    key = 'ee_signatures_%s_%s' % (ee.__version__, hashlib.md5(settings.EE_API_URL).hexdigest())
+    cached = memcache.get(key)
+    if cached:
+        return json.loads(zlib.decompress(cached))
+
+    path = signatures_path(settings.EE_API_URL)
+    if os.path.exists(path):
+        f = gzip.open(path)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    else:
+        ee.data.initialize(settings.EE_CREDENTIALS, settings.EE_API_URL + '/api', settings.EE_API_URL)
+        data = json.dumps(ee.data.getAlgorithms())
+    # compressed to fit in a memcache value
+    memcache.set(key, zlib.compress(data))
+    return json.loads(data)
+
+
+def _period_key(period):
+    """Returns the cache key part of a period, its end truncated to the day."""
+    return (period['start'], period['end'] - period['end'] % DAY_MS)
+
+
+def _graph_key(name, args):
+    """Returns the _graphs key of a product built from the given arguments."""
+    return (name,) + tuple(
+        _period_key(arg) if isinstance(arg, dict) else arg
+        for arg in args)
+
+
+def _graph_entry(key, build):
+    """Returns the _graphs entry of a key, calling build() on a miss."""
+    entry = _graphs.get(key)
+    if entry is None:
+        entry = {'image': build()}
+        _graphs.set(key, entry)
+    return entry
+
+
+def _graph_json(key, build):
+    """Returns the serialized JSON of a cached graph."""
+    entry = _graph_entry(key, build)
+    if 'json' not in entry:
+        entry['json'] = entry['image'].serialize()
+    return entry['json']
+
+
+def _cached_graph(periods=False):
+    """Caches the graphs an NDFI helper method builds in _graphs.
+
+    The method must be called with positional arguments only. Omitted ones
+    are filled in with their defaults, so both forms of a call share a key.
+
+    Args:
+      periods: Whether the method reads the periods of the helper, which are
+          then part of the key along with its arguments.
+    """
+    def decorator(build):
+        spec = inspect.getargspec(build)
+        defaults = spec.defaults or ()
+        # the number of arguments, not counting self
+        argc = len(spec.args) - 1
+
+        @functools.wraps(build)
+        def cached(self, *args):
+            args = args + defaults[len(defaults) - (argc - len(args)):]
+            return _graph_entry(self._graph_key(build.__name__, args, periods),
+                                lambda: build(self, *args))['image']
+        return cached
+    return decorator
+
 
 class Stats(object):
     """A class for calculating deforestation/degradation area stats."""
     DEFORESTATION = CLS_EDITED_DEFORESTATION
     DEGRADATION = CLS_EDITED_DEGRADATION
 
+    def __init__(self):
+        initialize()
+
     def get_stats_for_polygon(self, reports, polygon):
         """Computes deforestation area stats for a polygon on multiple images.
 
@@ -84,11 +224,9 @@ class Stats(object):
         feature = ee.Feature(ee.Feature.Polygon(polygon), {'name': 'myPoly'})
         polygons = ee.FeatureCollection([ee.Feature(feature)])
 
-        report_stats = []
-        for report_id, asset_id in reports:
-            result = self._get_area(report_id, asset_id, polygons)
-            if result is None: return None
-            report_stats.append(result[0])
+        results = self._get_areas(reports, polygons)
+        if results is None: return None
+        report_stats = [result[0] for result in results]
 
         stats = []
         for x in report_stats:
@@ -99,7 +237,7 @@ class Stats(object):
             })
         return stats
 
-    def get_stats(self, report_id, frozen_image, table_id):
+    def get_stats(self, report_id, frozen_image, table_id, zones=None, zone_column='name'):
         """Computes deforestation area stats for a given report.
 
         Args:
@@ -108,6 +246,10 @@ class Stats(object):
           frozen_image: The ID of the baseline image.
           table_id: The numeric ID of the Fusion Table containing the polygons
               to analyse.
+          zones: An optional list of zone ids, as returned by zone_id(). If
+              specified, only the rows of the table whose zone_column has
+              these values are analysed.
+          zone_column: The column of the table the zones come from.
 
         Returns:
           A dictionaty from polygon ID (<table_id>_<name>) to its stats,
@@ -118,15 +260,17 @@ class Stats(object):
             def: total deforested area in square km.
             deg: total degradation area in square km.
         """
-        result = self._get_area(
-            report_id, frozen_image, ee.FeatureCollection(int(table_id)))
+        polygons = ee.FeatureCollection(int(table_id))
+        if zones is not None:
+            polygons = polygons.filter(
+                ee.Filter.inList(zone_column, [_zone_value(z) for z in zones]))
+        result = self._get_area(report_id, frozen_image, polygons)
         if result is None: return None
         stats = {}
         for row in result:
-            name = row['name']
-            if isinstance(name, float): name = int(name)
+            name = zone_id(row['name'])
             stats['%s_%s' % (table_id, name)] = {
-                'id': str(name),
+                'id': name,
                 'table': table_id,
                 'total_area': row['total'] * METER2_TO_KM2,
                 'def': row[str(Stats.DEFORESTATION)] * METER2_TO_KM2,
@@ -173,14 +317,38 @@ class Stats(object):
           Stats.DEFORESTATION and Stats.DEGRADATION, specifying the area in
           square meters of each.
         """
-        freeze = self._get_historical_freeze(report_id, ee.Image(image_id))
-        return _get_area_histogram(
-            freeze, polygons, [Stats.DEFORESTATION, Stats.DEGRADATION])
+        return self._get_areas([(report_id, image_id)], polygons)[0]
+
+    def _get_areas(self, reports, polygons):
+        """Computes the deforestation and degradation of multiple reports.
+
+        The frozen images of all the reports are stacked and reduced over
+        the polygons together, so the number of EE requests does not grow
+        with the number of reports.
+
+        Args:
+          reports: A list of (report_id, image_id) tuples. See _get_area().
+          polygons: An ee.FeatureCollection of polygons to analyse.
+
+        Returns:
+          A list with one entry per report, in the same order as reports,
+          each in the format returned by _get_area().
+        """
+        if not reports:
+            return []
+        freezes = [self._get_historical_freeze(report_id, ee.Image(image_id))
+                   for report_id, image_id in reports]
+        return _get_area_histograms(
+            freezes, polygons, [Stats.DEFORESTATION, Stats.DEGRADATION],
+            reports[0][1])
 
 
 class EELandsat(object):
     """A helper for accessing Landsat 7 images."""
 
+    def __init__(self):
+        initialize()
+
     def list(self, bounds):
         """Returns a list of IDs of Landsat 7 images intersecting a given area.
 
@@ -228,13 +396,13 @@ class NDFI(object):
           last_period: The old period, as a 2-tuple of Unix timestamps.
           work_period: The new period, as a 2-tuple of Unix timestamps.
         """
+        initialize()
         self.last_period = dict(start=last_period[0], end=last_period[1])
         self.work_period = dict(start=work_period[0], end=work_period[1])
 
     def mapid2(self, asset_id):
         """Returns a Map ID for a visualization of the NDFI difference between last_period and work_period."""
-        return _get_raw_mapid(
-            self._ndfi_delta(asset_id).getMapId({'format': 'png'}))
+        return self._graph_mapid('_ndfi_delta', (asset_id,), {'format': 'png'}, True)
 
     def rgb0id(self):
         """Returns a Map ID for the RGB visualization of a MODIS mosaic for last_period."""
@@ -276,11 +444,17 @@ class NDFI(object):
           A description of the saved image which includes an ID.
         """
         result = self._make_map_to_freeze(asset_id, table_id, report_id)
-        return ee.data.createAsset(result.serialize(False))
+        created = ee.data.createAsset(result.serialize(False))
+        if 'data' in created:
+            invalidate_asset_metadata(created['data'].get('id'))
+        return created
 
     def rgb_stretch(self, polygon, sensor, bands, std_devs=2):
         """Returns a Map ID for a stretched mosaic visualized as RGB.
 
+        The stats of each band are cached, so other band combinations and
+        std_devs for the same region only need the getMapId call.
+
         Args:
           polygon: The GeoJSON polygon describing the region that will be
               visualized. The stats for this region will be used to calculate
@@ -298,9 +472,9 @@ class NDFI(object):
         Raises:
           RuntimeError: If a sensor other than "landsat" or "modis" is specified.
         """
-        NUM_SAMPLES = 10 ** 6
         RGB_BANDS = ['vis-red', 'vis-green', 'vis-blue']
 
+        version = None
         if sensor == 'modis':
             bands = ['sur_refl_b0%d' % i for i in bands]
             # Kriging is very expensive and does not significantly affect
@@ -325,28 +499,26 @@ class NDFI(object):
         elif sensor == 'landsat':
             bands = ['B%d' % i for i in bands]
             yesterday = datetime.date.today() - datetime.timedelta(1)
+            version = int(time.mktime(yesterday.timetuple()) * 1000000)
             collection = _get_landsat_toa(
                 self.work_period['start'] - 3 * 30 * 24 * 60 * 60 * 1000,
                 self.work_period['end'],
-                int(time.mktime(yesterday.timetuple()) * 1000000))
+                version)
             stats_image = display_image = collection.mosaic()
         else:
             raise RuntimeError('Sensor %s neither modis nor landsat.' % sensor)
-        stats_image = stats_image.select(bands, RGB_BANDS)
         display_image = display_image.select(bands, RGB_BANDS)
 
         # Calculate stats.
-        bbox = ee.Feature.Rectangle(*self._get_polygon_bbox(polygon))
-        stats = ee.data.getValue({
-            'image': stats_image.stats(NUM_SAMPLES, bbox).serialize(False),
-            'fields': ','.join(RGB_BANDS)
-        })
+        bbox = self._get_polygon_bbox(polygon)
+        key = (sensor,) + _period_key(self.work_period) + (version, bbox)
+        stats = self._band_stats(stats_image, bands, bbox, key)
         mins = []
         maxs = []
-        for band in RGB_BANDS:
-            band_stats = stats['properties'][band]['values']
-            min_value = band_stats['mean'] - std_devs * band_stats['total_sd']
-            max_value = band_stats['mean'] + std_devs * band_stats['total_sd']
+        for band in bands:
+            mean, std_dev = stats[band]
+            min_value = mean - std_devs * std_dev
+            max_value = mean + std_devs * std_dev
             if min_value == max_value:
                 min_value -= 1
                 max_value += 1
@@ -360,12 +532,51 @@ class NDFI(object):
             'max': ','.join(str(i) for i in maxs)
         }))
 
+    def _band_stats(self, image, bands, bbox, key):
+        """Returns the mean and standard deviation of bands in a bounding box.
+
+        Each band is cached in _stretch_stats under the key plus its name,
+        so only the bands not computed before are sampled, in one request.
+
+        Args:
+          image: The image to sample.
+          bands: The names of the bands.
+          bbox: The bounding box to sample, as returned by _get_polygon_bbox().
+          key: A tuple identifying the image and the bounding box.
+
+        Returns:
+          A dictionary mapping each band name to a (mean, std_dev) pair.
+        """
+        NUM_SAMPLES = 10 ** 6
+
+        stats = {}
+        missing = []
+        for band in bands:
+            cached = _stretch_stats.get(key + (band,))
+            if cached is not None:
+                stats[band] = cached
+            elif band not in missing:
+                missing.append(band)
+        if missing:
+            rect = ee.Feature.Rectangle(*bbox)
+            result = ee.data.getValue({
+                'image': image.select(missing).stats(NUM_SAMPLES, rect).serialize(False),
+                'fields': ','.join(missing)
+            })
+            for band in missing:
+                values = result['properties'][band]['values']
+                stats[band] = (values['mean'], values['total_sd'])
+                _stretch_stats.set(key + (band,), stats[band])
+        return stats
+
     def ndfi_change_value(self, asset_id, polygon, rows=5, cols=5):
         """Calculates NDFI delta stats between two periods in a given polygon.
 
         This method splits the supplied polygon using a grid specified by the
         rows and cols parameters, then for each cell, computes the number of
-        valid pixels and the total NDFI of all those pixels.
+        valid pixels and the total NDFI of all those pixels. The cells are
+        stacked as bands of a single image, so the whole grid is aggregated
+        with one request.
 
         Args:
           asset_id: The string ID of the baseline classification image. Should
@@ -419,29 +630,29 @@ class NDFI(object):
         diff = self._ndfi_delta(asset_id).select(0)
         masked = diff.mask(diff.mask().And(diff.lte(MAX_NDFI)))
 
-        # Aggregate each cell.
-        count_reducer = ee.Reducer.count()
-        sum_reducer = ee.Reducer.sum()
-        results = []
-        for y in range(rows):
-            for x in range(cols):
-                # Compose the reduction query for the cell.
-                index = y * cols + x
-                cell_img = masked.mask(masked.mask().And(index_image.eq(index)))
-                count_query = cell_img.reduceRegion(
-                    count_reducer, rect, None, MODIS_CRS, MODIS_TRANSFORM)
-                sum_query = cell_img.reduceRegion(
-                    sum_reducer, rect, None, MODIS_CRS, MODIS_TRANSFORM)
-                # Run the aggregations.
-                count = ee.data.getValue(
-                    {'json': ee.serializer.toJSON(count_query, False)})
-                summed = ee.data.getValue(
-                    {'json': ee.serializer.toJSON(sum_query, False)})
-                results.append([count, summed])
+        # Stack one band per cell so that all cells can be aggregated in a
+        # single request instead of two requests per cell.
+        cells_image = ee.Image().select([])
+        cell_bands = []
+        for index in range(rows * cols):
+            band = 'cell_%d' % index
+            cell_img = masked.mask(masked.mask().And(index_image.eq(index)))
+            cells_image = cells_image.addBands(cell_img.select([0], [band]))
+            cell_bands.append(band)
+
+        # Aggregate all the cells.
+        count_query = cells_image.reduceRegion(
+            ee.Reducer.count().forEachBand(cells_image),
+            rect, None, MODIS_CRS, MODIS_TRANSFORM)
+        sum_query = cells_image.reduceRegion(
+            ee.Reducer.sum().forEachBand(cells_image),
+            rect, None, MODIS_CRS, MODIS_TRANSFORM)
+        counted, summed = ee.data.getValue(
+            {'json': ee.serializer.toJSON(ee.List([count_query, sum_query]), False)})
 
         # Repackages the results in a backward-compatible form:
-        counts = [int(i[0]['ndfi']) for i in results]
-        sums = [int(i[1]['ndfi']) for i in results]
+        counts = [int(counted[band]) for band in cell_bands]
+        sums = [int(summed[band]) for band in cell_bands]
         return {
             'properties': {
                 'ndfiSum': {
@@ -468,7 +679,7 @@ class NDFI(object):
           A description of the image to save. The image is not yet saved.
         """
         asset = ee.Image(asset_id)
-        frozen_image = _remap_prodes_classes(asset)[0]
+        frozen_image = _remap_prodes_classes(asset_id)[0]
         # Remap CLS_EDITED_DEFORESTATION and CLS_EDITED_DEGRADATION to
         # CLS_DEFORESTED and CLS_DEGRADED.
         remapped = frozen_image.remap([0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
@@ -482,31 +693,50 @@ class NDFI(object):
 
     def _RGB_image_command(self, period, long_span=False):
         """Returns a Map ID for the RGB visualization of a MODIS mosaic for a given period."""
-        return _get_raw_mapid(self._kriged_mosaic(period, long_span).getMapId({
+        return self._graph_mapid('_kriged_mosaic', (period, long_span), {
             'bands': 'sur_refl_b01,sur_refl_b04,sur_refl_b03',
             'gain': 0.1,
             'bias': 0.0,
             'gamma': 1.6
-        }))
+        })
 
     def _SMA_image_command(self, period):
         """Returns a Map ID for the NDFI SMA image for a given period."""
-        return _get_raw_mapid(self._unmixed_mosaic(period).getMapId({
+        return self._graph_mapid('_unmixed_mosaic', (period, False), {
             'bands': 'gv,soil,npv',
             'gain': 256,
             'bias': 0.0,
             'gamma': 1.6
-        }))
+        })
 
     def _NDFI_period_image_command(self, period, long_span=False):
         """Returns a Map ID for the RGB visualization of a MODIS NDFI mosaic for a given period."""
-        return _get_raw_mapid(self._NDFI_visualize(period, long_span).getMapId({
+        return self._graph_mapid('_NDFI_visualize', (period, long_span), {
             'bands': 'vis-red,vis-green,vis-blue',
             'gain': 1,
             'bias': 0.0,
             'gamma': 1.6
-        }))
+        })
+
+    def _graph_key(self, name, args, periods=False):
+        """Returns the _graphs key of a product of this helper."""
+        if periods:
+            args = (self.last_period, self.work_period) + tuple(args)
+        return _graph_key(name, args)
+
+    def _graph_mapid(self, name, args, vis_params, periods=False):
+        """Returns a Map ID for the graph the named method builds.
+
+        The graph and its serialized JSON come from _graphs, so repeated
+        requests for the same product only make the getMapId call.
+        """
+        method = getattr(self, name)
+        params = dict(vis_params)
+        params['image'] = _graph_json(self._graph_key(name, args, periods),
+                                      lambda: method(*args))
+        return _get_raw_mapid(ee.data.getMapId(params))
 
+    @_cached_graph(periods=True)
     def _ndfi_delta(self, asset_id):
         """Computes a classification based on an difference in NDFI.
 
@@ -588,6 +818,7 @@ class NDFI(object):
 
         return result.byte().addBands(baseline)
 
+    @_cached_graph()
     def _paint_edited_deforestation(self, asset_id, month, year):  # pylint: disable-msg=unused-argument
         """Returns an image from an asset with edited deforestation painted on.
 
@@ -611,6 +842,7 @@ class NDFI(object):
         table = table.filterMetadata('asset_id', 'contains', date)
         return ee.Image(asset_id).paint(table, CLS_BASELINE)
 
+    @_cached_graph()
     def _NDFI_visualize(self, period, long_span=False):
         """Returns an RGB visualization of an NDFI mosaic for a given period.
 
@@ -629,6 +861,7 @@ class NDFI(object):
         rgb = ee.Image.cat(red, green, blue).round().byte()
         return rgb.select([0, 1, 2], ['vis-red', 'vis-green', 'vis-blue'])
 
+    @_cached_graph()
     def _NDFI_image(self, period, long_span=False):
         """Returns an NDFI mosaic based on MODIS for a given period.
 
@@ -651,6 +884,7 @@ class NDFI(object):
         ndfi = ndfi.where(summed.eq(0), INVALID_NDFI)
         return ndfi.select([0], ['ndfi'])
 
+    @_cached_graph()
     def _unmixed_mosaic(self, period, long_span=False):
         """Returns a mosaic with GV, SOIL and NPV indices based on MODIS.
 
@@ -684,6 +918,7 @@ class NDFI(object):
         result = unmixed.expression('addBands(b(0,1,2), round(max(b(0,1,2), 0) * 100))')
         return result.select(['.*'], OUTPUTS + [i + '_100' for i in OUTPUTS])
 
+    @_cached_graph()
     def _kriged_mosaic(self, period, long_span=False):
         """Returns an upscaled MODIS mosaic for a given period.
 
@@ -711,6 +946,7 @@ class NDFI(object):
         mosaic = self._make_mosaic(period, long_span)
         return ee.Algorithms.SAD.KrigeModis(mosaic, params)
 
+    @_cached_graph()
     def _make_mosaic(self, period, long_span=False):
         """Returns a mosaic of MODIS images for a given period.
 
@@ -861,11 +1097,20 @@ def get_prodes_stats(assetids, table_id):
 
       Where each <class value> is a number.
     """
-    results = []
+    initialize()
+    # the histograms of all the assets are requested at once
+    batch = ee.data.Batch()
+    queries = []
     for assetid in assetids:
-        prodes_image, classes = _remap_prodes_classes(ee.Image(assetid))
+        prodes_image, classes = _remap_prodes_classes(assetid)
         collection = ee.FeatureCollection(table_id)
-        raw_stats = _get_area_histogram(prodes_image, collection, classes)
+        query = _area_histograms_query([prodes_image], collection, assetid)
+        queries.append((classes, batch.getValue({'json': query.serialize()})))
+
+    results = []
+    for classes, future in queries:
+        raw_stats = _parse_area_histograms(
+            future.result()['features'], 1, classes)[0]
         stats = {}
         for raw_stat in raw_stats:
             values = {}
@@ -895,6 +1140,7 @@ def get_modis_thumbnail(image_id, cell, bands='sur_refl_b01,sur_refl_b04,sur_ref
     Returns:
       A dictionary containing "thumbid" and "token".
     """
+    initialize()
     MAX_ERROR_METERS = 500.0
     region = ee.Feature(_get_modis_tile(*cell)).bounds(MAX_ERROR_METERS)
     reprojected = region.getInfo()['geometry']['coordinates']
@@ -906,13 +1152,15 @@ def get_modis_thumbnail(image_id, cell, bands='sur_refl_b01,sur_refl_b04,sur_ref
     })
 
 
-def _get_area_histogram(image, polygons, classes):
+def _get_area_histogram(image, polygons, classes, asset_id):
     """Computes the area of class in each polygon.
 
     Args:
       image: The single-band image with class-valued pixels.
       polygons: An ee.FeatureCollection of polygons to analyse.
       classes: The integer class values to compute area for.
+      asset_id: The ID of the asset the image is derived from. Its projection
+          is used for the reduction.
 
     Returns:
       A list of dictionaries, one for each polygon in the polygons table in
@@ -922,31 +1170,72 @@ def _get_area_histogram(image, polygons, classes):
       entry for each class, the key being the class value and the value being
       the area of that class in square meters.
     """
+    return _get_area_histograms([image], polygons, classes, asset_id)[0]
+
+
+def _get_area_histograms(images, polygons, classes, asset_id):
+    """Computes the area of class in each polygon for several images at once.
+
+    The per-class area bands of all the images are stacked into one image,
+    so a single reduceRegions request covers every image.
+
+    Args:
+      images: A list of single-band images with class-valued pixels.
+      polygons: An ee.FeatureCollection of polygons to analyse.
+      classes: The integer class values to compute area for.
+      asset_id: The ID of the asset the first image is derived from. Its
+          projection is used for the whole reduction.
+
+    Returns:
+      A list with one entry per image, in the same order as images, each
+      being a list of dictionaries in the format returned by
+      _get_area_histogram().
+    """
+    stats_query = _area_histograms_query(images, polygons, asset_id)
+    return _parse_area_histograms(
+        stats_query.getInfo()['features'], len(images), classes)
+
+
+def _area_histograms_query(images, polygons, asset_id):
+    """Returns the reduction computed by _get_area_histograms()."""
     area_image = ee.Image.pixelArea()
     classes_image = ee.Image().select([])
-    for class_number in range(CLASSES_COUNT):
-      masked = area_image.mask(image.select('class').eq(class_number))
-      renamed = masked.select([0], ['cls-' + str(class_number)])
-      classes_image = classes_image.addBands(renamed)
+    for image_number, image in enumerate(images):
+      for class_number in range(CLASSES_COUNT):
+        masked = area_image.mask(image.select('class').eq(class_number))
+        renamed = masked.select([0], [_class_band(image_number, class_number)])
+        classes_image = classes_image.addBands(renamed)
     reducer = ee.Reducer.sum().forEachBand(classes_image)
-    proj = image.projection().getInfo()
-    stats_query = classes_image.reduceRegions(
+    proj = _get_asset_projection(asset_id)
+    return classes_image.reduceRegions(
         polygons, reducer, None, proj['crs'], proj['transform'])
-    stats = stats_query.getInfo()['features']
 
-    result = []
-    for feature in stats:
+
+def _parse_area_histograms(stats, images_count, classes):
+    """Returns the histograms of _get_area_histograms() from the features
+    of its reduction."""
+    results = []
+    for image_number in range(images_count):
+      result = []
+      for feature in stats:
         properties = feature['properties']
-        values = [properties['cls-' + str(i)] for i in range(CLASSES_COUNT)]
+        values = [properties[_class_band(image_number, i)]
+                  for i in range(CLASSES_COUNT)]
         row = {'name': properties['name'], 'total': sum(values)}
         for class_number in classes:
           row[str(class_number)] = values[class_number]
         result.append(row)
+      results.append(result)
 
-    return result
+    return results
 
 
-def _remap_prodes_classes(img):
+def _class_band(image_number, class_number):
+    """Returns the name of the area band of a class in a stacked image."""
+    return 'img%d-cls-%d' % (image_number, class_number)
+
+
+def _remap_prodes_classes(asset_id):
     """Remaps the values of the first band of a PRODES classification image.
 
     Uses the metadata fields class_names and class_indexes, taken either from
@@ -955,7 +1244,7 @@ def _remap_prodes_classes(img):
     used by this application.
 
     Args:
-      img: The single-band PRODES ee.Image.
+      asset_id: The ID of the single-band PRODES image.
 
     Returns:
       A 2-tuple, the first item being the remapped ee.Image with a "class" band
@@ -972,14 +1261,8 @@ def _remap_prodes_classes(img):
     RE_EDITED_DEGRADATION = re.compile(r'^degrad editado$')
     RE_EDITED_OLD_DEGRADATION = re.compile(r'^desmat antigo editado$')
 
-    # Try band metadata first. If not available, use image metadata.
-    info = img.getInfo()
-    band_metadata = info['bands'][0].get('properties', {})
-    image_metadata = info['properties']
-    class_names = band_metadata.get(
-        'class_names', image_metadata.get('class_names'))
-    classes_from = band_metadata.get(
-        'class_indexes', image_metadata.get('class_indexes'))
+    img = ee.Image(asset_id)
+    class_names, classes_from = _get_asset_classes(asset_id)
     classes_to = []
 
     for name in class_names:
@@ -1013,6 +1296,60 @@ def _remap_prodes_classes(img):
     return (final, set(classes_to))
 
 
+def _get_asset_classes(asset_id):
+    """Returns the class metadata of a classification asset.
+
+    The band metadata is tried first. If not available, the image metadata
+    is used. The result is cached by asset ID.
+
+    Args:
+      asset_id: The ID of the classification image.
+
+    Returns:
+      A 2-tuple with the class_names and class_indexes lists.
+    """
+    def fetch():
+        info = ee.Image(asset_id).getInfo()
+        band_metadata = info['bands'][0].get('properties', {})
+        image_metadata = info['properties']
+        class_names = band_metadata.get(
+            'class_names', image_metadata.get('class_names'))
+        class_indexes = band_metadata.get(
+            'class_indexes', image_metadata.get('class_indexes'))
+        return (class_names, class_indexes)
+    return _asset_metadata.get_or_compute(('classes', asset_id), fetch)
+
+
+def _get_asset_projection(asset_id):
+    """Returns the projection of the first band of an asset, cached by ID."""
+    return _asset_metadata.get_or_compute(
+        ('projection', asset_id),
+        lambda: ee.Image(asset_id).select(0).projection().getInfo())
+
+
+def invalidate_asset_metadata(asset_id):
+    """Drops any cached metadata for an asset ID."""
+    _asset_metadata.delete(('classes', asset_id))
+    _asset_metadata.delete(('projection', asset_id))
+
+
+def _zone_value(zone):
+    """Returns the value a zone id is stored as in a region table.
+
+    Numeric columns of the region tables hold floats, the others strings.
+
+    Args:
+      zone: A zone id string, as returned by zone_id().
+
+    Returns:
+      A float for numeric ids, the string otherwise.
+    """
+    try:
+        return float(zone)
+    except ValueError:
+        return zone
+
+
 def _paint(image, table_id, report_id, cls):
     """Paints a region from a Fusion Table onto an image.
 
@@ -0,0 +1,112 @@
+"""
+maps.py
+
+EE layers shown by default in the analysis view
+
+"""
+
+import datetime
+import logging
+import time
+
+import ee
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+from application.time_utils import timestamp, past_month_range
+from application.ee_bridge import NDFI, EELandsat
+from application import settings
+
+from application.models import Report
+
+# how long a request computing the maps of a report holds its lease and how
+# often the requests waiting for it check memcache
+LEASE_TIME = 30
+POLL_INTERVAL = 0.2
+
+
+def default_maps(r):
+    """ mapids of the default layers of report ``r``, requested concurrently
+        within the EE batch concurrency limit """
+    landsat = EELandsat()
+    ndfi = NDFI(past_month_range(r.start), r.range())
+    calls = [
+        ('LANDSAT/LE7_L1T', lambda: landsat.mapid(timestamp(r.start), datetime.datetime.now())),
+        ('SMA', ndfi.smaid),
+        ('RGB', ndfi.rgb1id),
+        ('NDFI T0', ndfi.ndfi0id),
+        ('NDFI T1', ndfi.ndfi1id),
+        ('Baseline', lambda: ndfi.baseline(r.base_map())),
+        ('Previous RGB', ndfi.rgb0id),
+    ]
+    batch = ee.data.Batch()
+    futures = [(name, batch.add(fn)) for name, fn in calls]
+    maps = []
+    for name, future in futures:
+        d = future.result()
+        if d:
+            maps.append({'data': d, 'info': name})
+    return maps
+
+def _cache_key(report_key):
+    return 'default_maps_%s' % report_key
+
+def refresh_default_maps(report_key):
+    """ compute and store the default maps of a report """
+    r = Report.get(report_key)
+    maps = default_maps(r)
+    memcache.set(_cache_key(report_key), {'maps': maps, 'created': time.time()},
+                 time=settings.MAP_TOKEN_LIFETIME)
+    memcache.delete(_cache_key(report_key) + '_refresh')
+    return maps
+
+def _refresh_shared(report_key, entry=None):
+    """ compute the default maps once for all the requests missing them
+
+        the request taking the lease computes them, the others serve the
+        maps of ``entry`` if any, or wait for the lease holder to store
+        new ones
+    """
+    key = _cache_key(report_key)
+    lease = key + '_lease'
+    if memcache.add(lease, 1, time=LEASE_TIME):
+        try:
+            return refresh_default_maps(report_key)
+        finally:
+            memcache.delete(lease)
+    if entry:
+        # their tokens last DEFAULT_MAPS_FRESH more seconds
+        return entry['maps']
+    deadline = time.time() + LEASE_TIME
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        found = memcache.get_multi([key, lease])
+        if key in found:
+            return found[key]['maps']
+        if lease not in found:
+            # the holder failed, errors are not cached
+            return refresh_default_maps(report_key)
+    logging.warning("gave up waiting for default maps of %s" % report_key)
+    return refresh_default_maps(report_key)
+
+def get_default_maps(r=None):
+    """ default maps of the current report, stale while revalidate
+
+        maps older than DEFAULT_MAPS_FRESH are served while a task refreshes
+        them, maps whose tokens may have expired are computed again, by one
+        request at a time
+    """
+    r = r or Report.current()
+    report_key = str(r.key())
+    entry = memcache.get(_cache_key(report_key))
+    if not entry:
+        return _refresh_shared(report_key)
+    age = time.time() - entry['created']
+    if age > settings.MAP_TOKEN_LIFETIME - settings.DEFAULT_MAPS_FRESH:
+        return _refresh_shared(report_key, entry)
+    if age > settings.DEFAULT_MAPS_FRESH:
+        # only one refresh task at a time
+        if memcache.add(_cache_key(report_key) + '_refresh', 1, time=settings.DEFAULT_MAPS_FRESH):
+            logging.info("refreshing default maps of %s" % report_key)
+            deferred.defer(refresh_default_maps, report_key)
+    return entry['maps']
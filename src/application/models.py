@@ -5,8 +5,15 @@ App Engine datastore models
 
 """
 
+import csv
 import logging
-import operator
+import os
+import re
+import time
+from collections import OrderedDict
+from StringIO import StringIO
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
@@ -21,6 +28,7 @@ from mercator import Mercator
 from ft import FT
 
 from kml import path_to_kml
+from application.constants import tables as stats_tables, zone_id
 
 CELL_BLACK_LIST = ['1_4_0', '1_0_4', '1_1_4', '1_4_4']
 
@@ -71,14 +79,102 @@ class User(db.Model):
         return json.dumps(self.as_dict())
 
 
+class ReportChain(object):
+    """ timeline of reports ordered by start date with their base assets
+
+        reports do not change their start once created and their asset once
+        closed, so the chain is kept in memcache and patched with compare
+        and set by the report being written when a report is created,
+        closed or deleted. It is memoized for the rest of the request
+    """
+    CACHE_KEY = 'report_chain'
+    # rebuilt from the datastore at least this often, in case a patch is lost
+    CACHE_TIME = 60 * 60
+    CAS_RETRIES = 5
+    _request = (None, None)
+
+    def __init__(self, reports):
+        # (key, start, assetid) tuples
+        self.reports = sorted(((str(r.key()), r.start, r.assetid) for r in reports),
+                              key=lambda x: x[1])
+
+    @staticmethod
+    def load():
+        """ chain of the stored reports. The query only provides the keys,
+            the reports are read by key so their assets are current
+        """
+        return ReportChain(r for r in Report.get(list(Report.all(keys_only=True))) if r)
+
+    @staticmethod
+    def get():
+        request_id = os.environ.get('REQUEST_LOG_ID')
+        rid, chain = ReportChain._request
+        if chain is None or rid != request_id or request_id is None:
+            chain = memcache.get(ReportChain.CACHE_KEY)
+            if chain is None:
+                chain = ReportChain.load()
+                # a chain patched meanwhile wins over this one
+                memcache.add(ReportChain.CACHE_KEY, chain, time=ReportChain.CACHE_TIME)
+            ReportChain._request = (request_id, chain)
+        return chain
+
+    @staticmethod
+    def update(key, report=None):
+        """ put ``report``, or remove the report with ``key`` when None, in
+            the cached chain
+        """
+        ReportChain._request = (None, None)
+        client = memcache.Client()
+        for _ in xrange(ReportChain.CAS_RETRIES):
+            chain = client.gets(ReportChain.CACHE_KEY)
+            if chain is None:
+                # the query may not see the write yet, the patch adds it
+                if client.add(ReportChain.CACHE_KEY, ReportChain.load().patched(key, report),
+                              time=ReportChain.CACHE_TIME):
+                    return
+            elif client.cas(ReportChain.CACHE_KEY, chain.patched(key, report),
+                            time=ReportChain.CACHE_TIME):
+                return
+        # too much contention, let the next request load it again
+        memcache.delete(ReportChain.CACHE_KEY)
+
+    def patched(self, key, report=None):
+        """ copy of the chain with ``report`` in place of the one with ``key`` """
+        chain = ReportChain([])
+        reports = [r for r in self.reports if r[0] != key]
+        if report is not None:
+            reports.append((key, report.start, report.assetid))
+        chain.reports = sorted(reports, key=lambda x: x[1])
+        return chain
+
+    def previous(self, report):
+        """ (key, start, assetid) of the report started before ``report`` """
+        prev = None
+        for r in self.reports:
+            if r[1] >= report.start:
+                break
+            prev = r
+        return prev
+
+    def next(self, report):
+        """ (key, start, assetid) of the report started after ``report`` """
+        for r in self.reports:
+            if r[1] > report.start:
+                return r
+        return None
+
+
 class Report(db.Model):
 
     start = db.DateProperty();
     end = db.DateProperty();
     finished = db.BooleanProperty(default=False);
-    cells_finished = db.IntegerProperty(default=0)
     total_cells = db.IntegerProperty(default=(25-len(CELL_BLACK_LIST))*25)
     assetid = db.StringProperty()
+    # cells of reports created before cells had key names need queries
+    keyed_cells = db.BooleanProperty(default=False)
+    # cell counters are kept up to date, older reports need a recount
+    cell_counters = db.BooleanProperty(default=False)
 
     # some stats
     degradation = db.FloatProperty(default=0.0)
@@ -92,7 +188,29 @@ class Report(db.Model):
             return r[0]
         return None
 
+    def __init__(self, *args, **kwargs):
+        super(Report, self).__init__(*args, **kwargs)
+        # what the report chain knows about this report
+        self._stored_chain = (self.start, self.assetid) if kwargs.get('_from_entity') else None
+
+    def put(self):
+        key = super(Report, self).put()
+        if self._stored_chain != (self.start, self.assetid):
+            ReportChain.update(str(key), self)
+            self._stored_chain = (self.start, self.assetid)
+        return key
+
+    def delete(self):
+        key = str(self.key())
+        super(Report, self).delete()
+        ReportChain.update(key)
+
+    def cells_finished_name(self):
+        return "r%s_cells_finished" % self.key().id_or_name()
+
     def cells_finished(self):
+        if self.cell_counters:
+            return CellCounter.get_counts([self.cells_finished_name()])[0]
         return Cell.all().filter('report =', self).filter('done =', True).count()
 
     def as_dict(self):
@@ -124,25 +242,31 @@ class Report(db.Model):
         return json.dumps(self.as_dict())
 
     def comparation_range(self):
-        r = self.previous()
+        r = ReportChain.get().previous(self)
         if r:
-            d = r.start
+            d = r[1]
         else:
             st = date(self.start.year, self.start.month, self.start.day)
             d = st - relativedelta(months=1)
         return tuple(map(timestamp, (d, self.start)))
 
     def base_map(self):
-        r = self.previous()
+        r = ReportChain.get().previous(self)
         if r:
-            return r.assetid
+            return r[2]
         #return "PRODES_2009"
         return "PRODES_IMAZON_2011a"
 
-    def previous(self):
-        r = Report.all().filter('start <', self.start).order('-start').fetch(1)
+    def previous_key(self):
+        r = ReportChain.get().previous(self)
         if r:
-            return r[0]
+            return db.Key(r[0])
+        return None
+
+    def previous(self):
+        key = self.previous_key()
+        if key:
+            return Report.get(key)
         return None
 
     def range(self):
@@ -177,8 +301,51 @@ class Cell(db.Model):
     map_four_layer_status = db.StringProperty(default='"Brazil Legal Amazon","false","Brazil Municipalities Public","false","Brazil States Public","false","Brazil Federal Conservation Unit Public","false","Brazil State Conservation Unit Public","false","Terrain","true","Satellite","false","Hybrid","false","Roadmap","false","LANDSAT/LE7_L1T","true","NDFI T0","false","True color RGB141","false","False color RGB421","false","F color infrared RGB214","false",*')
     
      
+    COUNTERS = ('notes', 'polygons', 'children_done')
+
+    def __init__(self, *args, **kwargs):
+        super(Cell, self).__init__(*args, **kwargs)
+        # done as stored in datastore, to count cells finished on write
+        self._stored_done = self.done if kwargs.get('_from_entity') else False
+
+    @staticmethod
+    def key_name_for(report, x, y, z):
+        if not isinstance(report, db.Key):
+            report = report.key()
+        return "r%s_%s_%s_%s" % (report.id_or_name(), z, x, y)
+
+    def counter_name(self, counter):
+        rkey = Cell.report.get_value_for_datastore(self)
+        return "%s_%s" % (Cell.key_name_for(rkey, self.x, self.y, self.z), counter)
+
+    def parent_counter_name(self, counter):
+        rkey = Cell.report.get_value_for_datastore(self)
+        return "%s_%s" % (Cell.key_name_for(rkey, *self.ancestors_pos()[0]), counter)
+
+    @staticmethod
+    def counts_for(r, cells):
+        """ return a dict with note, polygon and done children count for each cell """
+        if not r.cell_counters:
+            return [c.query_counts() for c in cells]
+        names = [c.counter_name(n) for c in cells for n in Cell.COUNTERS]
+        counts = CellCounter.get_counts(names)
+        n = len(Cell.COUNTERS)
+        return [dict(zip(Cell.COUNTERS, counts[i*n:(i+1)*n])) for i in xrange(len(cells))]
+
+    def query_counts(self):
+        if not self.is_saved():
+            return dict((n, 0) for n in Cell.COUNTERS)
+        return {
+            'notes': self.note_set.count(),
+            'polygons': self.polygon_count(),
+            'children_done': self.children_done()
+        }
+
     @staticmethod
     def get_cell(report, x, y, z):
+        cell = Cell.get_by_key_name(Cell.key_name_for(report, x, y, z))
+        if cell or report.keyed_cells:
+            return cell
         q = Cell.all()
         q.filter("z =", z)
         q.filter("x =", x)
@@ -189,34 +356,44 @@ class Cell(db.Model):
             return cell[0]
         return None
 
-    def child(self, i, j):
-        zz = self.z+1
-        xx = (SPLITS**self.z)*self.x + i
-        yy = (SPLITS**self.z)*self.y + j
+    def child_pos(self, i, j):
+        """ return (x, y, z) of a child cell """
+        return ((SPLITS**self.z)*self.x + i, (SPLITS**self.z)*self.y + j, self.z+1)
+
+    def child(self, i, j, create=True):
+        xx, yy, zz = self.child_pos(i, j)
+        if not create:
+            return Cell.get_or_default(self.report, xx, yy, zz)
         return Cell.get_or_create(self.report, xx, yy, zz)
 
+    def children_pos(self):
+        """ return (x, y, z) of child cells """
+        zz = self.z+1
+        return [((SPLITS**self.z)*self.x + i, (SPLITS**self.z)*self.y + j, zz)
+                for i in xrange(SPLITS) for j in xrange(SPLITS)]
+
     def children(self):
         """ return child cells """
-        eid = self.external_id()
-        childs = Cell.all()
-        childs.filter('report =', self.report)
-        childs.filter('parent_id =', eid)
-
-        children_cells = dict((x.external_id(), x) for x in childs.fetch(SPLITS*SPLITS))
+        r = self.report
+        pos = self.children_pos()
+        childs = Cell.get_by_key_name([Cell.key_name_for(r, *p) for p in pos])
+        children_cells = dict((x.external_id(), x) for x in childs if x)
+
+        if len(children_cells) < len(pos) and not r.keyed_cells:
+            childs = Cell.all()
+            childs.filter('report =', r)
+            childs.filter('parent_id =', self.external_id())
+            for x in childs.fetch(SPLITS*SPLITS):
+                children_cells.setdefault(x.external_id(), x)
 
         cells = []
-        for i in xrange(SPLITS):
-            for j in xrange(SPLITS):
-                zz = self.z+1
-                xx = (SPLITS**self.z)*self.x + i
-                yy = (SPLITS**self.z)*self.y + j
-
-                cid= "_".join(map(str,(zz, xx, yy)))
-                if cid in children_cells:
-                    cell = children_cells[cid]
-                else:
-                    cell = Cell.default_cell(self.report, xx, yy, zz)
-                cells.append(cell)
+        for xx, yy, zz in pos:
+            cid= "_".join(map(str,(zz, xx, yy)))
+            if cid in children_cells:
+                cell = children_cells[cid]
+            else:
+                cell = Cell.default_cell(r, xx, yy, zz)
+            cells.append(cell)
         return cells
 
     def calculate_ndfi_change_from_childs(self):
@@ -237,14 +414,20 @@ class Cell(db.Model):
         z, x, y = Cell.cell_id(pid)
         return Cell.get_or_default(self.report, x, y, z)
 
+    def ancestors_pos(self):
+        """ return (x, y, z) of parent cells up to the root """
+        pos = []
+        x, y, z = self.x, self.y, self.z
+        while z > 0:
+            x, y, z = x/SPLITS, y/SPLITS, z - 1
+            pos.append((x, y, z))
+        return pos
+
     def put(self):
-        self.parent_id = self.calc_parent_id()
-        p = self.get_parent()
-        # update parent
-        if p:
-            p.last_change_by = self.last_change_by
-            p.put()
-        super(Cell, self).put()
+        writer = CellWriter()
+        writer.add(self)
+        writer.commit()
+        return self.key()
 
     @staticmethod
     def cell_id(id):
@@ -265,34 +448,51 @@ class Cell(db.Model):
             cell = Cell.default_cell(r, x, y, z)
         return cell
 
+    @staticmethod
+    def get_or_default_many(r, positions):
+        """ like get_or_default for a list of (x, y, z) using one batch get """
+        cells = Cell.get_by_key_name([Cell.key_name_for(r, *p) for p in positions])
+        for i, (x, y, z) in enumerate(positions):
+            if not cells[i]:
+                if not r.keyed_cells:
+                    cells[i] = Cell.get_cell(r, x, y, z)
+                if not cells[i]:
+                    cells[i] = Cell.default_cell(r, x, y, z)
+        return cells
+
     @staticmethod
     def default_cell(r, x, y, z):
-        return Cell(z=z, x=x, y=y, ndfi_low=0.2, ndfi_high=0.3, report=r)
+        return Cell(key_name=Cell.key_name_for(r, x, y, z),
+                    z=z, x=x, y=y, ndfi_low=0.2, ndfi_high=0.3, report=r)
 
     def external_id(self):
         return "_".join(map(str,(self.z, self.x, self.y)))
 
-    def as_dict(self):
+    PANES = ('one', 'two', 'three', 'four')
+
+    def enabled_layers(self, pane):
+        """ names of the layers enabled in a compare view pane, in map order """
+        status = getattr(self, 'map_%s_layer_status' % pane)
+        return [name for name, on in re.findall(r'"([^"]*)","(true|false)"', status)
+                if on == 'true']
+
+    def as_dict(self, counts=None):
+        """ ``counts`` as returned by counts_for, fetched when not given """
         #latest = self.latest_polygon()
         t = 0
         by = 'Nobody'
+        if counts is None:
+            counts = Cell.counts_for(self.report, [self])[0]
         """
         if latest:
             t = timestamp(latest.added_on)
             by = latest.added_by.nickname()
         """
 
-        try:
-            self.key()
-            note_count = self.note_set.count()
+        if self.is_saved():
             t = timestamp(self.last_change_on)
             if self.last_change_by:
                 by = self.last_change_by.nickname()
-            children_done = self.children_done()
-        except:
-            note_count = 0
-            t = 0
-            children_done = 0
 
         return {
                 #'key': str(self.key()),
@@ -300,7 +500,7 @@ class Cell(db.Model):
                 'z': self.z,
                 'x': self.x,
                 'y': self.y,
-                'report_id': str(self.report.key()),
+                'report_id': str(Cell.report.get_value_for_datastore(self)),
                 'ndfi_low': self.ndfi_low,
                 'ndfi_high': self.ndfi_high,
                 'ndfi_change_value': self.ndfi_change_value,
@@ -312,19 +512,16 @@ class Cell(db.Model):
                 'done': self.done,
                 'latest_change': t,
                 'added_by': by,
-                'polygon_count': self.polygon_count(),
-                'note_count': note_count,
-                'children_done': children_done,
+                'polygon_count': counts['polygons'],
+                'note_count': counts['notes'],
+                'children_done': counts['children_done'],
                 'blocked': self.external_id() in CELL_BLACK_LIST
         }
 
     def polygon_count(self):
-        try:
-            self.key()
-        except:
-            #not saved
+        if not self.is_saved():
             return 0
-        return Area.all().filter('cell =', self).order('-added_on').count();
+        return Area.all().filter('cell =', self).count();
 
     def children_done(self):
         eid = self.external_id()
@@ -335,10 +532,7 @@ class Cell(db.Model):
         return childs.count()
 
     def latest_polygon(self):
-        try:
-            self.key()
-        except:
-            #not saved
+        if not self.is_saved():
             return None
         q = Area.all().filter('cell =', self).order('-added_on')
         o = q.fetch(1)
@@ -378,6 +572,57 @@ class Cell(db.Model):
         return {"type":"Polygon", "coordinates": [[ (sw[1], sw[0]), (sw[1], ne[0]), (ne[1], ne[0]), (ne[1], sw[0]) ]]}
 
 
+class CellWriter(object):
+    """ collects cell writes and commits them in one batch put
+
+        ancestors of the added cells get the last_change_by of their latest
+        changed child and are written once no matter how many children changed
+    """
+
+    def __init__(self):
+        self.cells = OrderedDict()
+
+    def _id(self, r, x, y, z):
+        return (str(r.key()), z, x, y)
+
+    def add(self, cell):
+        self.cells[self._id(cell.report, cell.x, cell.y, cell.z)] = cell
+
+    def commit(self):
+        reports = {}
+        changed_by = {}
+        for cell in self.cells.values():
+            cell.parent_id = cell.calc_parent_id()
+            for x, y, z in cell.ancestors_pos():
+                k = self._id(cell.report, x, y, z)
+                reports[k] = cell.report
+                changed_by[k] = cell.last_change_by
+
+        missing = [k for k in reports if k not in self.cells]
+        by_report = {}
+        for k in missing:
+            by_report.setdefault(k[0], []).append(k)
+        for keys in by_report.values():
+            r = reports[keys[0]]
+            positions = [(x, y, z) for _, z, x, y in keys]
+            for k, p in zip(keys, Cell.get_or_default_many(r, positions)):
+                p.parent_id = p.calc_parent_id()
+                self.cells[k] = p
+
+        for k, by in changed_by.iteritems():
+            self.cells[k].last_change_by = by
+        db.put(self.cells.values())
+
+        for cell in self.cells.values():
+            if cell.done != cell._stored_done:
+                delta = 1 if cell.done else -1
+                CellCounter.incr(cell.report.cells_finished_name(), delta)
+                if cell.z > 0:
+                    CellCounter.incr(cell.parent_counter_name('children_done'), delta)
+                cell._stored_done = cell.done
+        self.cells = OrderedDict()
+
+
 class Area(db.Model):
     """ area selected by user """
 
@@ -391,6 +636,12 @@ class Area(db.Model):
     fusion_tables_id = db.IntegerProperty()
     cell = db.ReferenceProperty(Cell)
 
+    def __init__(self, *args, **kwargs):
+        super(Area, self).__init__(*args, **kwargs)
+        # geometry as stored in datastore, used to find the stats regions
+        # an edit moves the polygon away from
+        self._stored_geo = self.geo if kwargs.get('_from_entity') else None
+
     def as_dict(self):
         return {
                 'id': str(self.key()),
@@ -414,16 +665,22 @@ class Area(db.Model):
         except db.NotSavedError:
             exists = False
         ret = self.put()
-        # call defer AFTER saving instance
+        # queue AFTER saving instance
         if not exists:
-            deferred.defer(self.create_fusion_tables)
-        else:
-            deferred.defer(self.update_fusion_tables)
+            CellCounter.incr(self.cell.counter_name('polygons'))
+        FTSync.enqueue(self)
+        geos = [self.geo]
+        if self._stored_geo and self._stored_geo != self.geo:
+            geos.append(self._stored_geo)
+        self._stored_geo = self.geo
+        StatsRegionEdit.enqueue(self, geos)
         return ret
 
     def delete(self):
         super(Area, self).delete()
-        deferred.defer(self.delete_fusion_tables)
+        CellCounter.incr(self.cell.counter_name('polygons'), -1)
+        FTSync.enqueue(self, deleted=True)
+        StatsRegionEdit.enqueue(self, [self.geo])
 
     @staticmethod
     def _get_ft_client():
@@ -446,26 +703,168 @@ class Area(db.Model):
         """ delete area from fusion tables. Do not use this method directly, call delete method"""
         cl = self._get_ft_client()
         table_id = cl.table_id(settings.FT_TABLE)
-        cl.sql("delete from %s where rowid = '%s'" % (table_id, self.fusion_tables_id))
+        cl.sql(Area.ft_delete_sql(table_id, self.fusion_tables_id))
 
     def update_fusion_tables(self):
         """ update polygon in fusion tables. Do not call this method, use save method when change instance data """
         logging.info("updating fusion tables %s" % self.key())
         cl = self._get_ft_client()
         table_id = cl.table_id(settings.FT_TABLE)
-        geo_kml = path_to_kml(json.loads(self.geo))
-        cl.sql("update  %s set geo = '%s', type = '%s' where rowid = '%s'" % (table_id, geo_kml, self.fusion_tables_type(), self.fusion_tables_id))
+        cl.sql(self.ft_update_sql(table_id))
 
     def create_fusion_tables(self):
         logging.info("saving to fusion tables report %s" % self.key())
         cl = self._get_ft_client()
         table_id = cl.table_id(settings.FT_TABLE)
-        geo_kml = path_to_kml(json.loads(self.geo))
-        rowid = cl.sql("insert into %s ('geo', 'added_on', 'type', 'report_id') VALUES ('%s', '%s', %d, %d)" % (table_id, geo_kml, self.added_on, self.fusion_tables_type(), self.cell.report.key().id()))
+        rowid = cl.sql(self.ft_insert_sql(table_id, self.cell.report.key().id()))
         self.fusion_tables_id = int(rowid.split('\n')[1])
-        rowid = cl.sql("update %s set rowid_copy = '%s' where rowid = '%s'" % (table_id, self.fusion_tables_id, self.fusion_tables_id))
+        cl.sql(Area.ft_rowid_copy_sql(table_id, self.fusion_tables_id))
         self.put()
 
+    def ft_insert_sql(self, table_id, report_id):
+        geo_kml = path_to_kml(json.loads(self.geo))
+        return "insert into %s ('geo', 'added_on', 'type', 'report_id') VALUES ('%s', '%s', %d, %d)" % (table_id, geo_kml, self.added_on, self.fusion_tables_type(), report_id)
+
+    def ft_update_sql(self, table_id):
+        geo_kml = path_to_kml(json.loads(self.geo))
+        return "update  %s set geo = '%s', type = '%s' where rowid = '%s'" % (table_id, geo_kml, self.fusion_tables_type(), self.fusion_tables_id)
+
+    @staticmethod
+    def ft_rowid_copy_sql(table_id, rowid):
+        return "update %s set rowid_copy = '%s' where rowid = '%s'" % (table_id, rowid, rowid)
+
+    @staticmethod
+    def ft_delete_sql(table_id, rowid):
+        return "delete from %s where rowid = '%s'" % (table_id, rowid)
+
+
+class FTSync(db.Model):
+    """ fusion tables change of an Area waiting to be flushed
+
+        key name is the area key, so any number of edits of a polygon
+        before the next flush collapse into one row write. ``deleted``
+        changes keep the FT row of the area, which is gone by then
+    """
+
+    # pending changes read by each flush, and inserts sent per FT request
+    FLUSH_SIZE = 200
+    INSERT_BATCH = 50
+    # changes whenever a flush writes to fusion tables
+    VERSION_KEY = 'ft_polygons_version'
+
+    deleted = db.BooleanProperty(default=False)
+    fusion_tables_id = db.IntegerProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def enqueue(area, deleted=False):
+        FTSync(key_name=str(area.key()),
+               deleted=deleted,
+               fusion_tables_id=area.fusion_tables_id).put()
+        FTSync.schedule_flush()
+
+    @staticmethod
+    def schedule_flush():
+        """ flush once the current FT_SYNC_DELAY window ends. The task is
+            named after the window so all the edits in it share one flush
+        """
+        now = time.time()
+        window = int(now / settings.FT_SYNC_DELAY) + 1
+        try:
+            deferred.defer(flush_fusion_tables,
+                           _name='ft-sync-%d' % window,
+                           _countdown=window * settings.FT_SYNC_DELAY - now)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def version():
+        """ version of the polygons in fusion tables """
+        version = memcache.get(FTSync.VERSION_KEY)
+        if version is None:
+            version = FTSync.new_version()
+        return version
+
+    @staticmethod
+    def new_version():
+        version = "%s" % time.time()
+        memcache.set(FTSync.VERSION_KEY, version)
+        return version
+
+
+def _ft_rowids(response, count):
+    """ rowids in the response to ``count`` insert statements """
+    rowids = [int(row[0]) for row in csv.reader(StringIO(response or '')) if row][1:]
+    if len(rowids) != count:
+        raise Exception("expected %d rowids from fusion tables, got: %s" % (count, response))
+    return rowids
+
+
+def flush_fusion_tables():
+    """ apply pending FTSync changes to fusion tables. Called deferred
+
+        new polygons are sent in multi statement inserts and their rowids
+        stored back with one put. FT updates and deletes take a single row
+        each so those are still sent one by one
+    """
+    pending = FTSync.all().fetch(FTSync.FLUSH_SIZE)
+    if not pending:
+        return
+    cl = Area._get_ft_client()
+    table_id = cl.table_id(settings.FT_TABLE)
+
+    areas = db.get([db.Key(p.key().name()) for p in pending])
+    inserts = []
+    updates = []
+    deletes = []
+    for change, area in zip(pending, areas):
+        if change.deleted:
+            # never reached fusion tables if it has no row
+            if change.fusion_tables_id:
+                deletes.append(change.fusion_tables_id)
+        elif area:
+            if area.fusion_tables_id:
+                updates.append(area)
+            else:
+                inserts.append(area)
+
+    if inserts:
+        cells = db.get(list(set(Area.cell.get_value_for_datastore(a) for a in inserts)))
+        report_ids = dict((c.key(), Cell.report.get_value_for_datastore(c).id()) for c in cells if c)
+        inserts = [a for a in inserts if Area.cell.get_value_for_datastore(a) in report_ids]
+        inserted = []
+        for i in xrange(0, len(inserts), FTSync.INSERT_BATCH):
+            batch = inserts[i:i + FTSync.INSERT_BATCH]
+            sql = ';'.join(a.ft_insert_sql(table_id, report_ids[Area.cell.get_value_for_datastore(a)]) for a in batch)
+            rowids = _ft_rowids(cl.sql(sql), len(batch))
+            # store the rowids of each batch right away so that, if a later
+            # batch fails, a retry does not insert this one again. Polygons
+            # deleted meanwhile are not brought back, their rows go
+            stored = []
+            for rowid, area in zip(rowids, db.get([a.key() for a in batch])):
+                if area:
+                    area.fusion_tables_id = rowid
+                    stored.append(area)
+                else:
+                    deletes.append(rowid)
+            db.put(stored)
+            inserted.extend(stored)
+        for area in inserted:
+            cl.sql(Area.ft_rowid_copy_sql(table_id, area.fusion_tables_id))
+
+    for area in updates:
+        cl.sql(area.ft_update_sql(table_id))
+    for rowid in deletes:
+        cl.sql(Area.ft_delete_sql(table_id, rowid))
+    logging.info("fusion tables flushed: %d inserts, %d updates, %d deletes" % (len(inserts), len(updates), len(deletes)))
+    FTSync.new_version()
+
+    # changes queued again while flushing are left for the next flush
+    current = db.get([p.key() for p in pending])
+    db.delete([p.key() for p, c in zip(pending, current) if c and c.updated == p.updated])
+    if len(pending) == FTSync.FLUSH_SIZE:
+        deferred.defer(flush_fusion_tables)
+
 class Note(db.Model):
     """ user note on a cell """
 
@@ -483,6 +882,49 @@ class Note(db.Model):
     def as_json(self):
         return json.dumps(self.as_dict())
 
+    def save(self):
+        exists = self.is_saved()
+        ret = self.put()
+        if not exists:
+            CellCounter.incr(self.cell.counter_name('notes'))
+        return ret
+
+class CellCounter(db.Model):
+    """ a count of cell children, notes or polygons
+
+        counters live apart from the cells so updating them never races with
+        cell writes. Key name is the cell counter_name, or the report
+        cells_finished_name for report wide counts
+    """
+    count = db.IntegerProperty(default=0)
+
+    @staticmethod
+    def incr(name, delta=1):
+        def txn():
+            c = CellCounter.get_by_key_name(name) or CellCounter(key_name=name)
+            c.count += delta
+            c.put()
+        db.run_in_transaction(txn)
+
+    @staticmethod
+    def get_counts(names):
+        return [c.count if c else 0 for c in CellCounter.get_by_key_name(names)]
+
+    @staticmethod
+    def recount(r):
+        """ rebuild the counters of a report from its cells, notes and polygons """
+        counters = {}
+        finished = 0
+        for cell in Cell.all().filter('report =', r):
+            for name, count in cell.query_counts().iteritems():
+                counters[cell.counter_name(name)] = count
+            if cell.done:
+                finished += 1
+        counters[r.cells_finished_name()] = finished
+        db.put([CellCounter(key_name=k, count=v) for k, v in counters.iteritems()])
+        r.cell_counters = True
+        r.put()
+
 class Error(db.Model):
     """ javascript errors registered """
     msg = db.TextProperty(required=True)
@@ -492,44 +934,370 @@ class Error(db.Model):
 
 
 class StatsStore(db.Model):
+    """ region stats of a report
+
+        ``json`` keeps the whole stats document served to the client, while
+        the stats of each region table are also stored by column in a
+        StatsTable child so exports only load the table they need.
+        Stores are keyed by report id, older ones only have ``report_id`` set
+    """
     report_id = db.StringProperty()
     json = db.TextProperty()
+    updated = db.DateTimeProperty(auto_now=True)
 
     @staticmethod
     def get_for_report(id):
+        s = StatsStore.get_by_key_name(id)
+        if s:
+            return s
         try:
             s = StatsStore.all().filter('report_id =', id).fetch(1)[0]
             return s
         except IndexError:
             return None
 
+    @staticmethod
+    def get_for_reports(ids):
+        """ stores of a list of report ids, None for reports without stats """
+        stores = StatsStore.get_by_key_name(ids)
+        return [s or StatsStore.get_for_report(id) for id, s in zip(ids, stores)]
+
+    @staticmethod
+    def save_for_report(report_id, stats):
+        """ save stats document (``{'id': ..., 'stats': {...}}``) for a report,
+            replacing any previous one
+        """
+        s = StatsStore(key_name=report_id, report_id=report_id, json=json.dumps(stats))
+        s._as_dict = stats
+        by_table = {}
+        for v in stats['stats'].itervalues():
+            by_table.setdefault(str(v['table']), []).append(v)
+        tables = [StatsTable.from_rows(s, table, rows) for table, rows in by_table.iteritems()]
+        db.put([s] + tables)
+        s._tables = dict((t.table_id(), t) for t in tables)
+
+        # remove stats of tables no longer present and stores in old format
+        keep = set(t.key() for t in tables)
+        stale = [k for k in StatsTable.all(keys_only=True).ancestor(s) if k not in keep]
+        stale += [x.key() for x in StatsStore.all().filter('report_id =', report_id) if x.key() != s.key()]
+        if stale:
+            db.delete(stale)
+        return s
+
     def as_dict(self):
         if not hasattr(self, '_as_dict'):
             self._as_dict = json.loads(self.json)
         return self._as_dict
 
+    def table(self, table):
+        """ return StatsTable for table or None if there are no stats for it """
+        if not hasattr(self, '_tables'):
+            self._tables = {}
+        table = str(table)
+        if table not in self._tables:
+            t = None
+            if self.key().name():
+                t = StatsTable.get_by_key_name(StatsTable.key_name_for(table), parent=self)
+            else:
+                # old format, build it from the stats document
+                rows = [v for v in self.as_dict()['stats'].itervalues() if str(v['table']) == table]
+                if rows:
+                    t = StatsTable.from_rows(self, table, rows)
+            self._tables[table] = t
+        return self._tables[table]
+
     def for_table(self, table, zone=None):
-        tb = [v for k, v in self.as_dict()['stats'].iteritems() if str(v['table']) == str(table)]
+        t = self.table(table)
+        if not t:
+            return []
         if zone:
-            return [x for x in tb if str(x['id']) == zone]
-
-        return tb
-
+            row = t.row(zone)
+            return [row] if row else []
+        return t.rows()
 
     def table_accum(self, table, zone=None):
-        table_stats = self.for_table(table, zone)
-        if not table_stats:
+        t = self.table(table)
+        stats = t and t.accum(zone)
+        if not stats:
             logging.info("no stats for %s on %s" % (table, self.report_id))
             return None
-        return [{
-            'id': zone,
-            'def': reduce(operator.add, map(float, (x['def'] for x in table_stats))),
-            'deg': reduce(operator.add, map(float, (x['deg'] for x in table_stats)))
-        }]
+        return stats
+
+class StatsTable(db.Model):
+    """ stats of a report for one region table, child of StatsStore
+
+        rows are stored by column in ``json`` with the totals precomputed
+    """
+    json = db.TextProperty()
+    def_total = db.FloatProperty(default=0.0)
+    deg_total = db.FloatProperty(default=0.0)
+
+    COLUMNS = ('def', 'deg', 'total_area')
+
+    @staticmethod
+    def key_name_for(table):
+        # key names can't start with a digit
+        return "t%s" % table
+
+    @staticmethod
+    def for_report(report_id, table):
+        """ return StatsTable for report and table without loading the whole store """
+        t = StatsTable.get(db.Key.from_path('StatsStore', report_id,
+                                            'StatsTable', StatsTable.key_name_for(table)))
+        if t:
+            return t
+        s = StatsStore.get_for_report(report_id)
+        if s and not s.key().name():
+            return s.table(table)
+        return None
+
+    @staticmethod
+    def from_rows(store, table, rows):
+        columns = {'id': [str(x['id']) for x in rows]}
+        for c in StatsTable.COLUMNS:
+            columns[c] = [float(x[c]) if x.get(c) is not None else None for x in rows]
+        t = StatsTable(parent=store,
+                       key_name=StatsTable.key_name_for(table),
+                       json=json.dumps(columns),
+                       # zones EE failed to compute have no values
+                       def_total=sum(x or 0.0 for x in columns['def']),
+                       deg_total=sum(x or 0.0 for x in columns['deg']))
+        t._columns = columns
+        return t
+
+    def table_id(self):
+        return self.key().name()[1:]
+
+    def columns(self):
+        if not hasattr(self, '_columns'):
+            self._columns = json.loads(self.json)
+        return self._columns
+
+    def index(self):
+        """ zone id -> row number """
+        if not hasattr(self, '_index'):
+            self._index = dict((x, i) for i, x in enumerate(self.columns()['id']))
+        return self._index
+
+    def _row(self, i):
+        columns = self.columns()
+        row = {'id': columns['id'][i], 'table': self.table_id()}
+        for c in StatsTable.COLUMNS:
+            row[c] = columns[c][i]
+        return row
+
+    def rows(self):
+        return [self._row(i) for i in xrange(len(self.columns()['id']))]
+
+    def row(self, zone):
+        i = self.index().get(str(zone))
+        if i is None:
+            return None
+        return self._row(i)
+
+    def accum(self, zone=None):
+        if zone:
+            row = self.row(zone)
+            if not row:
+                return None
+            return [{'id': zone, 'def': row['def'], 'deg': row['deg']}]
+        return [{'id': zone, 'def': self.def_total, 'deg': self.deg_total}]
+
+class StatsRegionChange(db.Model):
+    """ region rows touched by polygon edits since the report stats were
+        last computed, one entity per report and region table
+    """
+    report_id = db.StringProperty()
+    table = db.StringProperty()
+    zones = db.StringListProperty()
+
+    @staticmethod
+    def key_name_for(report_id, table):
+        return "%s_%s" % (report_id, table)
+
+    @staticmethod
+    def for_report(report_id):
+        return StatsRegionChange.all().filter('report_id =', report_id).fetch(len(stats_tables))
+
+    @staticmethod
+    def add(report_id, table, zones):
+        key_name = StatsRegionChange.key_name_for(report_id, table)
+        def txn():
+            c = StatsRegionChange.get_by_key_name(key_name)
+            if not c:
+                c = StatsRegionChange(key_name=key_name, report_id=report_id, table=str(table))
+            c.zones = sorted(set(c.zones) | set(zones))
+            c.put()
+        db.run_in_transaction(txn)
+
+    @staticmethod
+    def remove(report_id, table, zones):
+        """ forget zones once their stats have been recomputed """
+        key_name = StatsRegionChange.key_name_for(report_id, table)
+        def txn():
+            c = StatsRegionChange.get_by_key_name(key_name)
+            if not c:
+                return
+            c.zones = sorted(set(c.zones) - set(zones))
+            if c.zones:
+                c.put()
+            else:
+                c.delete()
+        db.run_in_transaction(txn)
+
+
+class StatsRegionEdit(db.Model):
+    """ geometries of a polygon edit whose stats region rows are not in
+        StatsRegionChange yet
+
+        key name is the area key, so the edits of a polygon collapse into
+        one entity until record_region_changes looks them up, once per
+        FT_SYNC_DELAY window and report
+    """
+    # pending edits read by each lookup
+    FETCH_SIZE = 500
+
+    report_id = db.StringProperty()
+    cell = db.StringProperty(indexed=False)
+    geos = db.TextProperty(default='[]')
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def enqueue(area, geos):
+        """ add area paths json strings to the pending edit of an area """
+        report_id = str(Cell.report.get_value_for_datastore(area.cell))
+        key_name = str(area.key())
+        def txn():
+            e = StatsRegionEdit.get_by_key_name(key_name)
+            if not e:
+                e = StatsRegionEdit(key_name=key_name,
+                                    report_id=report_id,
+                                    cell=str(Area.cell.get_value_for_datastore(area)))
+            e.geos = json.dumps(sorted(set(json.loads(e.geos)) | set(geos)))
+            e.put()
+        db.run_in_transaction(txn)
+        StatsRegionEdit.schedule(report_id)
+
+    @staticmethod
+    def schedule(report_id):
+        """ look the edits of a report up once the current FT_SYNC_DELAY
+            window ends, in a task named after the report and the window
+        """
+        now = time.time()
+        window = int(now / settings.FT_SYNC_DELAY) + 1
+        try:
+            deferred.defer(record_region_changes, report_id,
+                           _name='region-edits-%s-%d' % (db.Key(report_id).id_or_name(), window),
+                           _countdown=window * settings.FT_SYNC_DELAY - now)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def for_report(report_id):
+        return StatsRegionEdit.all().filter('report_id =', report_id).fetch(StatsRegionEdit.FETCH_SIZE)
+
+
+def _bbox_rect(geos):
+    """ FT RECTANGLE of the bounding box of area paths json strings """
+    points = []
+    for geo in geos:
+        for path in json.loads(geo):
+            points.extend(path)
+    if not points:
+        return None
+    lats = [p[0] for p in points]
+    lngs = [p[1] for p in points]
+    return "RECTANGLE(LATLNG(%f, %f), LATLNG(%f, %f))" % (min(lats), min(lngs), max(lats), max(lngs))
+
+
+def record_region_changes(report_id):
+    """ record the stats region rows touched by the pending StatsRegionEdit
+        of a report in StatsRegionChange. The edits of each cell are looked
+        up together, with one query per region table for their bounding box.
+        Called deferred from StatsRegionEdit and before incremental updates
+    """
+    edits = StatsRegionEdit.for_report(report_id)
+    if not edits:
+        return
+    cl = FT(settings.FT_CONSUMER_KEY,
+            settings.FT_CONSUMER_SECRET,
+            settings.FT_TOKEN,
+            settings.FT_SECRET)
+    by_cell = {}
+    for e in edits:
+        by_cell.setdefault(e.cell, []).extend(json.loads(e.geos))
+    by_table = {}
+    for geos in by_cell.itervalues():
+        rect = _bbox_rect(geos)
+        if not rect:
+            continue
+        for desc, table, name in stats_tables:
+            info = cl.sql("select %s from %s where ST_INTERSECTS(geometry, %s)" % (name, table, rect))
+            if not info:
+                # the edits are kept, so the task retries them
+                raise Exception("can't get regions of %s for %s" % (desc, report_id))
+            zones = [zone_id(row[0]) for row in csv.reader(StringIO(info)) if row][1:]
+            by_table.setdefault(table, set()).update(zones)
+    for table, zones in by_table.iteritems():
+        if zones:
+            StatsRegionChange.add(report_id, table, zones)
+
+    # edits changed while looking them up are left for the next task
+    current = db.get([e.key() for e in edits])
+    db.delete([e.key() for e, c in zip(edits, current) if c and c.updated == e.updated])
+    logging.info("region changes of %s: %d edits in %d cells" % (report_id, len(edits), len(by_cell)))
+    if len(edits) == StatsRegionEdit.FETCH_SIZE:
+        deferred.defer(record_region_changes, report_id)
+
 
 class FustionTablesNames(db.Model):
+    """ region names of a stats table, written by the fusion_tables_names
+        command
+
+        instances keep the parsed names of each table until the command
+        writes new ones, which changes the version kept in memcache. The
+        version is checked once per request
+    """
     table_id = db.StringProperty()
     json = db.TextProperty()
 
+    VERSION_KEY = 'fusion_tables_names_version'
+    # (version, {table_id: names}) of this instance
+    _names = (None, {})
+    _request = None
+
     def as_dict(self):
         return json.loads(self.json)
+
+    @staticmethod
+    def version():
+        """ version of the names, checked once per request """
+        version, names = FustionTablesNames._names
+        request_id = os.environ.get('REQUEST_LOG_ID')
+        if request_id is None or request_id != FustionTablesNames._request:
+            current = memcache.get(FustionTablesNames.VERSION_KEY)
+            if current is None:
+                # unknown once evicted, so start a new one
+                current = FustionTablesNames.new_version()
+            if current != version:
+                version, names = FustionTablesNames._names = (current, {})
+            FustionTablesNames._request = request_id
+        return version
+
+    @staticmethod
+    def names(table_id):
+        """ dict of region id to name of a table """
+        FustionTablesNames.version()
+        names = FustionTablesNames._names[1]
+        table_names = names.get(str(table_id))
+        if table_names is None:
+            t = FustionTablesNames.all().filter('table_id =', str(table_id)).get()
+            table_names = names[str(table_id)] = t.as_dict() if t else {}
+        return table_names
+
+    @staticmethod
+    def new_version():
+        """ make every instance load the names again """
+        version = "%s_%s" % (time.time(), os.environ.get('INSTANCE_ID', ''))
+        memcache.set(FustionTablesNames.VERSION_KEY, version)
+        return version
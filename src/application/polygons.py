@@ -0,0 +1,88 @@
+"""
+polygons.py
+
+Canonical form of user drawn polygons and a cache of their stats by report
+
+"""
+
+import hashlib
+import logging
+
+import simplejson as json
+from google.appengine.api import memcache
+
+from application import settings
+from application.models import FTSync
+
+# decimal places coordinates are rounded to, about 10cm
+PRECISION = 6
+
+
+def canonical_polygon(ring, precision=PRECISION):
+    """ canonical form of a ring of (lng, lat) points
+
+        coordinates are rounded, repeated points and the closing point
+        dropped, the ring is wound counter-clockwise as EE expects and
+        starts at its westmost point (the smallest longitude, then the
+        smallest latitude). The returned ring is closed again
+    """
+    points = []
+    for p in ring:
+        p = (round(float(p[0]), precision), round(float(p[1]), precision))
+        if not points or points[-1] != p:
+            points.append(p)
+    while len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    if not points:
+        return []
+
+    # shoelace formula, negative for clockwise rings
+    area = sum(a[0] * b[1] - b[0] * a[1] for a, b in zip(points, points[1:] + points[:1]))
+    if area < 0:
+        points.reverse()
+    start = points.index(min(points))
+    points = points[start:] + points[:start]
+    return points + points[:1]
+
+
+def polygon_hash(ring):
+    """ hash of a ring, the same for every ring with the same canonical form """
+    return _digest(canonical_polygon(ring))
+
+
+def _digest(polygon):
+    return hashlib.md5(json.dumps(polygon)).hexdigest()
+
+
+def _report_version(r):
+    """ closed reports never change, open ones change with every polygon
+        edit flushed to fusion tables
+    """
+    if r.finished:
+        return 'a%s' % r.assetid
+    return 'v%s' % FTSync.version()
+
+
+def polygon_stats(ee_stats, reports, ring):
+    """ def, deg and total_area of a (lng, lat) ring for each report
+
+        stats are cached by canonical polygon and report, only the reports
+        missing from the cache are sent to EE, in a single call. Return a
+        list in the same order as reports, or None if EE failed
+    """
+    polygon = canonical_polygon(ring)
+    h = _digest(polygon)
+    keys = ["%s_%s_%s" % (h, r.key().id(), _report_version(r)) for r in reports]
+    cached = memcache.get_multi(keys, namespace='polygon_stats')
+
+    missing = [(key, r) for key, r in zip(keys, reports) if key not in cached]
+    if missing:
+        logging.info("polygon %s: %d of %d reports not cached" % (h, len(missing), len(reports)))
+        stats = ee_stats.get_stats_for_polygon(
+            [(str(r.key().id()), r.assetid) for key, r in missing], [polygon])
+        if stats is None:
+            return None
+        computed = dict((key, s) for (key, r), s in zip(missing, stats))
+        memcache.set_multi(computed, time=settings.POLYGON_STATS_TIME, namespace='polygon_stats')
+        cached.update(computed)
+    return [cached[key] for key in keys]
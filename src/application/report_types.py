@@ -5,123 +5,175 @@ Classes for describing different report formats.
 
 """
 
+import hashlib
 import logging
 import csv
+import os
 from application import settings
 from google.appengine.ext import deferred
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 from ft import FT
 from flask import Response, abort, request
+from google.appengine.api import memcache
 from StringIO import StringIO
-from models import FustionTablesNames, StatsStore
+from models import FustionTablesNames, StatsTable
+from cache import TwoTierCache
+
+# KML geometry of region table rows, keyed by (table, row id). Region
+# tables do not change, so entries only expire to free memcache. Geometries
+# vary from a few KB to several MB, so the instance keeps them up to a total
+# size rather than a number of rows
+_geometries = TwoTierCache('kml_geometry', time=60 * 60 * 24 * 7, max_bytes=32 * 1024 * 1024)
+
+# rendered exports larger than this are not cached, memcache values are
+# limited to 1MB
+MAX_CACHED_EXPORT = 900 * 1024
 
 
 class ReportType(object):
+    """ writer of an export document
 
-    zone = None
+        instances hold the state of a single request. generate() yields
+        the document piece by piece so it can be streamed by response()
+    """
 
-    def init(self, zone):
-        self.f.truncate(0)
-        self.zone = zone
-   
-    def set_zone(self):
+    def __init__(self, zone=None):
         self.zone = zone
-    
-    def write_row(self, report, table=None, kml=None):
-        raise NotImplementedError
 
-    def write_header(self):
+    def header(self):
         raise NotImplementedError
 
-    def write_footer(self):
+    def row(self, report, stats, table=None, kml=None):
         raise NotImplementedError
 
-    def value(self):
+    def footer(self):
         raise NotImplementedError
 
-    def response(self, file_name):
+    def response(self, body, file_name):
         raise NotImplementedError
 
+    def prefetch(self, table, row_ids):
+        """ called with the ids of all the rows of table before writing them """
+        pass
+
+    def cached_response(self, etag, last_modified, render, file_name):
+        """ response for an export identified by ``etag``
+
+            304 if the client has it, the cached document if rendered
+            before or else the one ``render()`` returns, as generate() does,
+            which is cached once complete. render is called before
+            answering so it can still abort
+        """
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            body = memcache.get(etag, namespace='exports')
+            if body is None:
+                body = self._caching(render(), etag)
+            else:
+                body = [body]
+            response = self.response(body, file_name)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _caching(self, chunks, etag):
+        """ pass chunks through, storing the whole document unless too big """
+        out = []
+        size = 0
+        for chunk in chunks:
+            if out is not None:
+                out.append(chunk)
+                size += len(chunk)
+                if size > MAX_CACHED_EXPORT:
+                    out = None
+            yield chunk
+        if out is not None:
+            memcache.set(etag, ''.join(out), time=settings.EXPORT_CACHE_TIME, namespace='exports')
+
+    def generate(self, rows):
+        """ yield the document for ``rows``, an iterable of row() arguments """
+        yield self.header()
+        for row in rows:
+            yield self.row(*row)
+        yield self.footer()
+
     def get_stats(self, report, table):
         report_id = str(report.key())
-        st = StatsStore.get_for_report(report_id)
+        st = StatsTable.for_report(report_id, table)
         if not st:
            logging.error("no cached stats for %s" % report_id)
            abort(404)
 
         if self.zone:
-            stats = st.table_accum(table, self.zone)
-            if not stats:
-                logging.error("no stats for %s" % report_id)
-                abort(404)
+            stats = st.accum(self.zone)
         else:
-            stats = st.for_table(table)
-            if not stats:
-                logging.error("no stats for %s" % report_id)
-                abort(404)
+            stats = st.rows()
+        if not stats:
+            logging.error("no stats for %s" % report_id)
+            abort(404)
         return stats
 
     def get_polygon_name(self, table, id):
-            all_table_names = FustionTablesNames.all()
-            filtered_table_names = all_table_names.filter('table_id =', table)
-            table_names=filtered_table_names.fetch(1)[0].as_dict()
-            name = table_names.get(id, id)
-            return name
+            return FustionTablesNames.names(table).get(id, id)
     
     @staticmethod
-    def factory(format):
+    def factory(format, zone=None):
         if (format == "kml"):
-            return KMLReportType()
+            return KMLReportType(zone)
         else:
-            return CSVReportType()
+            return CSVReportType(zone)
       
         
 
 class CSVReportType(ReportType):
 
-    f = StringIO()
-    csv_file = csv.writer(f)
+    def __init__(self, zone=None):
+        super(CSVReportType, self).__init__(zone)
+        self.f = StringIO()
+        self.csv_file = csv.writer(self.f)
 
-    def write_header(self):
+    def _line(self, values):
+        self.f.truncate(0)
+        self.csv_file.writerow(values)
+        return self.f.getvalue()
+
+    def header(self):
         if self.zone:
-            self.csv_file.writerow(('report_id', 'start_date', 'end_date', 
+            return self._line(('report_id', 'start_date', 'end_date', 
                 'deforested', 'degraded'))
         else:
-            self.csv_file.writerow(('report_id', 'start_date', 'end_date', 
+            return self._line(('report_id', 'start_date', 'end_date', 
                 'zone_id', 'deforested', 'degraded'))
 
-    def write_footer(self):
-        pass    
+    def footer(self):
+        return ''
 
-    def write_row(self, report, stats, table=None, kml=None):
+    def row(self, report, stats, table=None, kml=None):
         name = None
 
         if table and not self.zone:
             name = self.get_polygon_name(table, stats['id'])
             
         if name:
-            self.csv_file.writerow((str(report.key().id()),
+            return self._line((str(report.key().id()),
                     report.start.isoformat(),
                     report.end.isoformat(),
                     name,
                     stats['def'],
                     stats['deg']))
         else:
-            self.csv_file.writerow((str(report.key().id()),
+            return self._line((str(report.key().id()),
                     report.start.isoformat(),
                     report.end.isoformat(),
                     stats['def'],
                     stats['deg']))
         
 
-    def value(self):
-        return self.f.getvalue()
-
-    def response(self, file_name):
-        result = self.value()
-        self.f.truncate(0)
-        return Response(result, 
+    def response(self, body, file_name):
+        return Response(body, 
             headers={
                 "Content-Disposition": "attachment; filename=\"" + file_name + 
                 ".csv\""
@@ -130,23 +182,20 @@ class CSVReportType(ReportType):
 
 class KMLReportType(ReportType):
 
-    f = StringIO()
-
-    def write_header(self):
-        self.f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>")
-        self.f.write("<kml xmlns=\"http://www.opengis.net/kml/2.2\">")
-        self.f.write("<Document>")
-        self.f.write("<Style id=\"transGreenPoly\"><LineStyle>" +
+    def header(self):
+        return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>" +
+            "<kml xmlns=\"http://www.opengis.net/kml/2.2\">" +
+            "<Document>" +
+            "<Style id=\"transGreenPoly\"><LineStyle>" +
             "<width>2.5</width></LineStyle><PolyStyle>" +
-            "<color>3d00ff00</color></PolyStyle>")
-        self.f.write("<BalloonStyle><text>$[description]</text>" + 
+            "<color>3d00ff00</color></PolyStyle>" +
+            "<BalloonStyle><text>$[description]</text>" + 
             "</BalloonStyle></Style>")
 
-    def write_footer(self):
-        self.f.write("</Document>")
-        self.f.write("</kml>")
+    def footer(self):
+        return "</Document></kml>"
 
-    def write_row(self, report, stats, table=None, kml=None):
+    def row(self, report, stats, table=None, kml=None):
         name = None
 
         if table:
@@ -157,43 +206,65 @@ class KMLReportType(ReportType):
 
         description = self.description(name, stats)
 
-        self.f.write("<Placemark>")
-        self.f.write("<styleUrl>#transGreenPoly</styleUrl>")
+        out = ["<Placemark>", "<styleUrl>#transGreenPoly</styleUrl>"]
         if (name):
-          self.f.write("<name>" + name + "</name>")
-        self.f.write("<description>" + description + "</description>")
-        self.f.write(kml)
-        self.f.write("</Placemark>")
-
-    def value(self):
-        return self.f.getvalue()
-
-    def response(self, file_name):
-        result = self.value()
-        self.f.truncate(0)
-        return Response(result, 
+          out.append("<name>" + name + "</name>")
+        out.append("<description>" + description + "</description>")
+        out.append(kml)
+        out.append("</Placemark>")
+        return ''.join(out)
+
+    def response(self, body, file_name):
+        return Response(body, 
             headers={
                 "Content-Disposition": "attachment; filename=\"" + file_name + 
                 ".kml\""
             },
             mimetype='text/kml')
 
-    def kml(self, table, row_id):
-        cl = FT(settings.FT_CONSUMER_KEY,
-                settings.FT_CONSUMER_SECRET,
-                settings.FT_TOKEN,
-                settings.FT_SECRET)
+    # row ids sent in each geometry query, keeping the GET url short
+    PREFETCH_BATCH = 100
+
+    def ft(self):
+        if not getattr(self, '_ft', None):
+            self._ft = FT(settings.FT_CONSUMER_KEY,
+                    settings.FT_CONSUMER_SECRET,
+                    settings.FT_TOKEN,
+                    settings.FT_SECRET)
+        return self._ft
 
+    def id_column(self, table):
         #TODO: do this better
         if (table == 1568452):
-          id = 'ex_area'
-        else:
-          id = 'name'
+          return 'ex_area'
+        return 'name'
+
+    def prefetch(self, table, row_ids):
+        """ load the geometries of row_ids not cached yet with bulk queries """
+        keys = dict((geometry_key(table, row_id), str(row_id)) for row_id in set(row_ids))
+        cached = _geometries.get_multi(keys.keys())
+        missing = [row_id for key, row_id in keys.iteritems() if key not in cached]
+        id = self.id_column(table)
+        for i in xrange(0, len(missing), self.PREFETCH_BATCH):
+            ids = missing[i:i + self.PREFETCH_BATCH]
+            info = self.ft().sql("select %s, geometry from %s where %s in (%s)" %
+                (id, table, id, ', '.join(ids)))
+            if not info:
+                logging.error("can't get geometries from %s" % table)
+                continue
+            for row in list(csv.reader(StringIO(info)))[1:]:
+                if row:
+                    cache_geometry(table, row[0], row[1].replace("\"", ""))
 
-        info = cl.sql("select geometry from %s where %s = %s" % 
-            (table, id, row_id))
+    def kml(self, table, row_id):
+        polygon = _geometries.get(geometry_key(table, row_id))
+        if polygon is not None:
+            return polygon
+        info = self.ft().sql("select geometry from %s where %s = %s" %
+            (table, self.id_column(table), row_id))
         polygon = info.split('\n')[1]
         polygon = polygon.replace("\"", "")
+        cache_geometry(table, row_id, polygon)
         return polygon
 
     def description(self, name, stats):
@@ -211,3 +282,35 @@ class KMLReportType(ReportType):
         
       
 
+
+
+def geometry_key(table, row_id):
+    """ cache key of a row. FT returns numeric ids as floats, so 12 and 12.0
+        are the same row
+    """
+    row_id = str(row_id)
+    try:
+        number = float(row_id)
+        if number == int(number):
+            row_id = str(int(number))
+    except ValueError:
+        pass
+    return "%s_%s" % (table, row_id)
+
+
+def cache_geometry(table, row_id, polygon):
+    try:
+        _geometries.set(geometry_key(table, row_id), polygon)
+    except ValueError:
+        # too large for memcache, keep it in this instance only, where it
+        # counts against the size budget like any other
+        _geometries.local.set(geometry_key(table, row_id), polygon)
+
+
+def export_etag(*parts):
+    """ etag of an export built from ``parts``, the normalized request and
+        the versions of the data it shows. The app version is included so
+        a deploy never serves documents rendered by older code
+    """
+    parts += (os.environ.get('CURRENT_VERSION_ID'),)
+    return hashlib.md5(repr(parts)).hexdigest()
@@ -13,8 +13,11 @@ from application.time_utils import timestamp
 
 from application.constants import amazon_bounds
 from application import settings
+from application.commands import update_report_stats_incremental
+from application.maps import refresh_default_maps
 
 from google.appengine.ext.db import Key
+from google.appengine.ext import deferred
 from google.appengine.api import users
 
 from google.appengine.api import memcache
@@ -27,16 +30,24 @@ class NDFIMapApi(Resource):
     def _cache_key(report_id):
         return report_id + "_ndfi"
 
-    def list(self, report_id):
-        cache_key = self._cache_key(report_id)
+    @staticmethod
+    def get_map(report_id):
+        """ mapid and token of the report ndfi analysis layer """
+        cache_key = NDFIMapApi._cache_key(report_id)
         data = memcache.get(cache_key)
         if not data:
             r = Report.get(Key(report_id))
             ndfi = NDFI(r.comparation_range(), r.range())
             data = ndfi.mapid2(r.base_map())
             if not data:
-                abort(404)
+                return None
             memcache.add(key=cache_key, value=data, time=3600)
+        return data
+
+    def list(self, report_id):
+        data = self.get_map(report_id)
+        if not data:
+            abort(404)
         return jsonify(data)
 
 
@@ -92,11 +103,17 @@ class ReportAPI(Resource):
                 abort(400)
             data = data['data']['id']
             r.close(data)
+            # only the regions touched by this report polygons need stats.
+            # Run after the last edit window so its edits are recorded
+            deferred.defer(update_report_stats_incremental, report_id,
+                           _countdown=2 * settings.FT_SYNC_DELAY)
             cache_key = NDFIMapApi._cache_key(report_id)
             memcache.delete(cache_key)
             # open new report
-            new_report = Report(start=date.today())
+            new_report = Report(start=date.today(), keyed_cells=True, cell_counters=True)
             new_report.put()
+            # have the default maps of the new report ready before it is used
+            deferred.defer(refresh_default_maps, str(new_report.key()))
             return str(new_report.key())
         return "already finished"
 
@@ -113,19 +130,24 @@ class CellAPI(Resource):
     def list(self, report_id):
         r = Report.get(Key(report_id))
         cell = Cell.get_or_default(r, 0, 0, 0)
-        return self._as_json([x.as_dict() for x in iter(cell.children()) if not self.is_in_backlist(x)])
+        return self._cells_as_json(r, cell.children())
 
     def children(self, report_id, id):
         r = Report.get(Key(report_id))
         z, x, y = Cell.cell_id(id)
         cell = Cell.get_or_default(r, x, y, z)
-        cells = cell.children()
-        return self._as_json([x.as_dict() for x in cells if not self.is_in_backlist(x)])
+        return self._cells_as_json(r, cell.children())
+
+    def _cells_as_json(self, r, cells):
+        cells = [x for x in cells if not self.is_in_backlist(x)]
+        counts = Cell.counts_for(r, cells)
+        return self._as_json([x.as_dict(c) for x, c in zip(cells, counts)])
 
     def get(self, report_id, id):
         r = Report.get(Key(report_id))
         z, x, y = Cell.cell_id(id)
         cell = Cell.get_or_default(r, x, y, z)
+        cell.report = r
         return Response(cell.as_json(), mimetype='application/json')
 
     def update(self, report_id, id):
@@ -10,7 +10,8 @@ from google.appengine.ext import deferred
 
 from application.models import Report, StatsStore
 from application.ee_bridge import Stats
-from application.commands import update_report_stats
+from application.polygons import polygon_stats
+from application.commands import update_report_stats_incremental
 
 from google.appengine.api import memcache
 
@@ -42,13 +43,13 @@ class RegionStatsAPI(Resource):
         cache_key = 'stats_' + report_id
         data = memcache.get(cache_key)
         if not data:
-            try:
-                data = StatsStore.all().filter('report_id =', report_id).fetch(1)[0].json
-            except IndexError:
+            st = StatsStore.get_for_report(report_id)
+            if not st:
                 # launch caching!
                 logging.info("launching stats calc")
-                deferred.defer(update_report_stats, report_id)
+                deferred.defer(update_report_stats_incremental, report_id)
                 abort(404)
+            data = st.json
             memcache.set(cache_key, data)
         return Response(data, mimetype='application/json')
 
@@ -68,10 +69,9 @@ class RegionStatsAPI(Resource):
         except ValueError:
             logging.error("can't find some report")
             abort(404)
-        #TODO: test if polygon is ccw
         # exchange lat, lon -> lon, lat
         normalized_poly = [(coord[1], coord[0]) for coord in polygon]
-        stats = self.ee.get_stats_for_polygon([(str(r.key().id()), r.assetid) for r in reports], [normalized_poly])
+        stats = polygon_stats(self.ee, reports, normalized_poly)
         try:
             # aggregate
             data['def'] = sum(s['def'] for s in stats)
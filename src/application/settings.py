@@ -43,10 +43,42 @@ else:
         FT_TABLE = 'SAD EE Polygons'
         FT_TABLE_ID = '2949980'
 
-# Initialize the EE API.
+# The EE API is initialized on first use by ee_bridge.initialize()
 EE_TILE_SERVER = EE_API_URL + '/map/'
 ee.data.DEFAULT_DEADLINE = 60 * 20
-ee.Initialize(EE_CREDENTIALS, EE_API_URL)
+
+# Independent EE requests are sent up to EE_CONCURRENCY at a time
+EE_CONCURRENCY = 4
+ee.data.setBatchConcurrency(EE_CONCURRENCY)
+ee.data.setPoolSize(EE_CONCURRENCY)
+
+# Region stats are computed with up to STATS_CONCURRENCY parallel EE calls,
+# started at no more than STATS_CALLS_PER_SECOND, retrying throttled ones
+STATS_CONCURRENCY = 3
+STATS_CALLS_PER_SECOND = 0.5
+STATS_RETRIES = 3
+
+# EE tiles proxied through /ee/tiles are kept up to TILE_CACHE_BYTES in each
+# instance and TILE_CACHE_TIME seconds in memcache
+TILE_CACHE_BYTES = 32 * 1024 * 1024
+TILE_CACHE_TIME = 60 * 60 * 24
+TILE_MAX_AGE = 60 * 60
+
+# default maps of the analysis view are refreshed in the background once
+# older than DEFAULT_MAPS_FRESH seconds and never served after their EE
+# tokens, valid for MAP_TOKEN_LIFETIME seconds, could have expired
+DEFAULT_MAPS_FRESH = 60 * 10
+MAP_TOKEN_LIFETIME = 60 * 60 * 6
+
+# polygon edits are written to fusion tables in batches, flushed every
+# FT_SYNC_DELAY seconds
+FT_SYNC_DELAY = 30
+
+# rendered stats exports are cached for EXPORT_CACHE_TIME seconds
+EXPORT_CACHE_TIME = 60 * 60 * 24
+
+# stats of user drawn polygons are cached for POLYGON_STATS_TIME seconds
+POLYGON_STATS_TIME = 60 * 60 * 24 * 7
 
 # Set secret keys for CSRF protection
 SECRET_KEY = CSRF_SECRET_KEY
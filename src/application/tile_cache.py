@@ -0,0 +1,134 @@
+"""
+tile_cache.py
+
+Cache of EE map tiles served by the tile proxy and their composites
+
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+from cache import SizedLRUCache
+
+
+NAMESPACE = 'tiles'
+# how long a fetch holds the lease of a tile and how often the instances
+# waiting for it check memcache
+LEASE_TIME = 10
+POLL_INTERVAL = 0.1
+
+
+class TileCache(object):
+    """ tiles keyed by their mapid/z/x/y path in an in-process LRU bounded
+        by size and backed by memcache.
+
+        Tiles are stored with the token they were fetched with and only
+        served to requests with the same token, the token EE pairs with
+        each mapid. Concurrent misses of a tile share one upstream fetch:
+        threads of an instance wait for the thread fetching it and other
+        instances wait for the holder of its memcache lease
+    """
+
+    def __init__(self, server, max_bytes, time=0):
+        self.server = server
+        self.time = time
+        self.local = SizedLRUCache(max_bytes, lambda t: len(t['content']))
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _valid(self, tile, token):
+        return tile is not None and tile['token'] == token
+
+    def cached(self, path, token):
+        tile = self.local.get(path)
+        if self._valid(tile, token):
+            return tile
+        tile = memcache.get(path, namespace=NAMESPACE)
+        if self._valid(tile, token):
+            self.local.set(path, tile)
+            return tile
+        return None
+
+    def get(self, path, token):
+        """ return the tile as a dict with content, content_type, etag and
+            status, fetching it from the tile server on a miss
+        """
+        tile = self.cached(path, token)
+        if tile:
+            return tile
+
+        with self._lock:
+            event = self._inflight.get(path)
+            leader = event is None
+            if leader:
+                event = self._inflight[path] = threading.Event()
+        if not leader:
+            event.wait(LEASE_TIME)
+            return self.cached(path, token) or self.fetch(path, token)
+
+        try:
+            return self._get_shared(path, token)
+        finally:
+            with self._lock:
+                del self._inflight[path]
+            event.set()
+
+    def _get_shared(self, path, token):
+        lease = 'lease:' + path
+        if memcache.add(lease, 1, time=LEASE_TIME, namespace=NAMESPACE):
+            try:
+                return self.fetch(path, token)
+            finally:
+                memcache.delete(lease, namespace=NAMESPACE)
+        # another instance is fetching it. Errors are not cached, so stop
+        # waiting as soon as the lease is released without a tile
+        deadline = time.time() + LEASE_TIME
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            found = memcache.get_multi([path, lease], namespace=NAMESPACE)
+            tile = found.get(path)
+            if self._valid(tile, token):
+                self.local.set(path, tile)
+                return tile
+            if lease not in found:
+                return self.fetch(path, token)
+        logging.warning("gave up waiting for tile %s" % path)
+        return self.fetch(path, token)
+
+    def fetch(self, path, token):
+        result = urlfetch.fetch(self.server + path + '?token=' + token, deadline=10)
+        tile = {
+            'token': token,
+            'status': result.status_code,
+            'content': result.content,
+            'content_type': result.headers.get('Content-Type'),
+            'etag': '"%s"' % hashlib.md5(result.content).hexdigest()
+        }
+        if result.status_code == 200:
+            self.local.set(path, tile)
+            memcache.set(path, tile, time=self.time, namespace=NAMESPACE)
+        return tile
+
+
+def composite(tiles, size=256, time=0):
+    """ blend ``tiles``, as returned by TileCache.get, bottom to top into a
+        single png. Return (content, etag), or (None, None) when none of the
+        tiles was fetched. Composites are cached in memcache by the etags of
+        their tiles
+    """
+    tiles = [t for t in tiles if t['status'] == 200]
+    if not tiles:
+        return None, None
+    etag = '"%s"' % hashlib.md5(''.join(t['etag'] for t in tiles)).hexdigest()
+    content = memcache.get(etag, namespace='composites')
+    if content is None:
+        layers = [(t['content'], 0, 0, 1.0, images.TOP_LEFT) for t in tiles]
+        content = images.composite(layers, size, size, output_encoding=images.PNG)
+        memcache.set(etag, content, time=time, namespace='composites')
+    return content, etag
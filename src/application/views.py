@@ -1,6 +1,5 @@
 # encoding: utf-8
 
-import datetime
 import logging
 import os
 import simplejson as json
@@ -22,45 +21,21 @@ except:
   flask = zipimport.zipimporter('packages/flask.zip').load_module('flask')
   wtforms = zipimport.zipimporter('packages/wtforms.zip').load_module('wtforms')
 
-from application.time_utils import timestamp, past_month_range
-
 from decorators import login_required, admin_required
 from forms import ExampleForm
-from application.ee_bridge import NDFI, EELandsat, get_modis_thumbnail
+from application.ee_bridge import get_modis_thumbnail, initialize as initialize_ee
+from application.maps import get_default_maps
+from application.tile_cache import TileCache, composite
+from application.concurrency import run_parallel
 
 from app import app
 
-from models import Report, User, Error
+from models import Report, Cell, User, Error
 from google.appengine.api import memcache
 from google.appengine.ext.db import Key
 
 from application import settings
 
-def default_maps():
-    maps = []
-    r = Report.current() 
-    logging.info("report " + unicode(r))
-    landsat = EELandsat()
-    ndfi = NDFI(past_month_range(r.start), r.range())
-
-    d = landsat.mapid(timestamp(r.start), datetime.datetime.now())
-    maps.append({'data' :d, 'info': 'LANDSAT/LE7_L1T'})
-    #d = ndfi.mapid2()
-    #if d: maps.append({'data' :d, 'info': 'ndfi difference'})
-    d = ndfi.smaid()
-    if d: maps.append({'data': d, 'info': 'SMA'})
-    d = ndfi.rgb1id()
-    if d: maps.append({'data': d, 'info': 'RGB'})
-    d = ndfi.ndfi0id()
-    if d: maps.append({'data': d, 'info': 'NDFI T0'})
-    d = ndfi.ndfi1id()
-    if d: maps.append({'data' :d, 'info': 'NDFI T1'})
-    d = ndfi.baseline(r.base_map())
-    if d: maps.append({'data' :d, 'info': 'Baseline'})
-    d = ndfi.rgb0id()
-    if d: maps.append({'data': d, 'info': 'Previous RGB'})
-    return maps
-
 def get_or_create_user():
     user = users.get_current_user()
     u = User.get_user(user)
@@ -76,15 +51,11 @@ def start():
 @app.route('/analysis')
 @login_required
 def home(cell_path=None):
-    maps = memcache.get('default_maps')
-    if maps:
-        maps = json.loads(maps)
-    else:
-        maps = default_maps()
-        memcache.add(key='default_maps', value=json.dumps(maps), time=60*10)
+    r = Report.current()
+    maps = get_default_maps(r)
 
     # send only the active report
-    reports = json.dumps([Report.current().as_dict()])
+    reports = json.dumps([r.as_dict()])
     u = get_or_create_user()
     if not u:
         abort(403)
@@ -142,16 +113,79 @@ def tiles(tile_path):
 
 
 EARTH_ENGINE_TILE_SERVER = settings.EE_TILE_SERVER
+ee_tiles = TileCache(EARTH_ENGINE_TILE_SERVER, settings.TILE_CACHE_BYTES, settings.TILE_CACHE_TIME)
 
 @app.route('/ee/tiles/<path:tile_path>')
 def earth_engine_tile_proyx(tile_path):
     token = request.args.get('token', '')
     if not token:
         abort(401)
-    result = urlfetch.fetch(EARTH_ENGINE_TILE_SERVER + tile_path + '?token='+ token, deadline=10)
+    tile = ee_tiles.get(tile_path, token)
+    if tile['status'] != 200:
+        response = make_response(tile['content'], tile['status'])
+        response.headers['Content-Type'] = tile['content_type']
+        return response
+
+    if request.headers.get('If-None-Match') == tile['etag']:
+        response = make_response('', 304)
+    else:
+        response = make_response(tile['content'])
+        response.headers['Content-Type'] = tile['content_type']
+    response.headers['ETag'] = tile['etag']
+    response.headers['Cache-Control'] = 'public, max-age=%d' % settings.TILE_MAX_AGE
+    return response
 
-    response = make_response(result.content)
-    response.headers['Content-Type'] = result.headers['Content-Type']
+def analysis_layers(r):
+    """ mapid and token of the default EE layers of a report by name. The
+        NDFI analysis layer is not included, it is filtered client side
+        from its raw values
+    """
+    return dict((m['info'], m['data']) for m in get_default_maps(r))
+
+@app.route('/ee/composite/<report_id>/<cell_id>/<pane>/<int:z>/<int:x>/<int:y>')
+@login_required
+def earth_engine_composite_tile(report_id, cell_id, pane, z, x, y):
+    """ EE layers of a pane of a cell blended in one tile
+
+        the layers are given bottom to top in the ``layers`` argument, a
+        comma separated list of names, or taken from the layer status the
+        cell stores for the pane
+    """
+    if pane not in Cell.PANES:
+        abort(404)
+    r = Report.get(Key(report_id))
+    names = request.args.get('layers')
+    if names:
+        names = names.split(',')
+    else:
+        cz, cx, cy = Cell.cell_id(cell_id)
+        names = Cell.get_or_default(r, cx, cy, cz).enabled_layers(pane)
+    available = analysis_layers(r)
+    layers = [available[name] for name in names if name in available]
+    if not layers:
+        abort(404)
+
+    calls = [(l['mapid'], lambda l=l: ee_tiles.get("%s/%d/%d/%d" % (l['mapid'], z, x, y), l['token']))
+             for l in layers]
+    results = run_parallel(calls, concurrency=len(calls))
+    for res in results:
+        if res.error:
+            raise res.error
+    tiles = [res.value for res in results]
+    content, etag = composite(tiles, time=settings.TILE_CACHE_TIME)
+    if content is None:
+        # no layer has this tile, pass the error of the first one on
+        response = make_response(tiles[0]['content'], tiles[0]['status'])
+        response.headers['Content-Type'] = tiles[0]['content_type']
+        return response
+
+    if request.headers.get('If-None-Match') == etag:
+        response = make_response('', 304)
+    else:
+        response = make_response(content)
+        response.headers['Content-Type'] = 'image/png'
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, max-age=%d' % settings.TILE_MAX_AGE
     return response
 
 @app.route('/proxy/<path:tile_path>')
@@ -175,6 +209,8 @@ def warmup():
     See http://code.google.com/appengine/docs/python/config/appconfig.html#Warming_Requests
 
     """
+    # load the EE algorithm signatures before serving
+    initialize_ee()
     return ''
 
 @app.route('/picker')
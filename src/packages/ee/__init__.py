@@ -12,6 +12,7 @@ import json
 import numbers
 import os
 import sys
+import threading
 
 import oauth2client.client  # pylint: disable=g-bad-import-order
 
@@ -56,11 +57,26 @@ class _AlgorithmsContainer(dict):
   def __delattr__(self, name):
     del self[name]
 
+class _LazyAlgorithmsContainer(_AlgorithmsContainer):
+  """The top level of Algorithms, filled in on first use."""
+
+  def __getitem__(self, name):
+    _InitializeUnboundMethods()
+    return dict.__getitem__(self, name)
+
 # A dictionary of algorithms that are not bound to a specific class.
-Algorithms = _AlgorithmsContainer()
+Algorithms = _LazyAlgorithmsContainer()
+
+# Whether Algorithms has been filled in.
+_unboundMethodsInitialized = False
+
+# Guards the lazy binding of Algorithms and of the generated classes, which
+# may be first used by several threads at once. Reentrant, as binding the
+# functions of a class looks its attributes up.
+_bindLock = threading.RLock()
 
 
-def Initialize(credentials='persistent', opt_url=None):
+def Initialize(credentials='persistent', opt_url=None, opt_signatures=None):
   """Initialize the EE library.
 
   If this hasn't been called by the time any object constructor is used,
@@ -73,12 +89,14 @@ def Initialize(credentials='persistent', opt_url=None):
         credentials already stored in the filesystem, or raise an explanatory
         exception guiding the user to create those credentials.
     opt_url: The base url for the EarthEngine REST API to connect to.
+    opt_signatures: The algorithm signatures, as returned by
+        data.getAlgorithms(), to use instead of fetching them from the server.
   """
   if credentials == 'persistent':
     credentials = _GetPersistentCredentials()
   data.initialize(credentials, (opt_url + '/api' if opt_url else None), opt_url)
   # Initialize the dynamically loaded functions on the objects that want them.
-  ApiFunction.initialize()
+  ApiFunction.initialize(opt_signatures)
   Element.initialize()
   Image.initialize()
   Feature.initialize()
@@ -93,7 +111,6 @@ def Initialize(credentials='persistent', opt_url=None):
   Date.initialize()
   Dictionary.initialize()
   _InitializeGeneratedClasses()
-  _InitializeUnboundMethods()
 
 
 def Reset():
@@ -114,8 +131,9 @@ def Reset():
   Date.reset()
   Dictionary.reset()
   _ResetGeneratedClasses()
-  global Algorithms
-  Algorithms = _AlgorithmsContainer()
+  global Algorithms, _unboundMethodsInitialized
+  Algorithms = _LazyAlgorithmsContainer()
+  _unboundMethodsInitialized = False
 
 
 def _GetPersistentCredentials():
@@ -314,6 +332,23 @@ def _Promote(arg, klass):
 
 
 def _InitializeUnboundMethods():
+  """Attaches the functions not bound to any class to Algorithms."""
+  global _unboundMethodsInitialized
+  if _unboundMethodsInitialized:
+    return
+  with _bindLock:
+    if not _unboundMethodsInitialized:
+      _BindUnboundMethods()
+      # Only set once bound, other threads wait for the lock until then.
+      _unboundMethodsInitialized = True
+
+
+def _BindUnboundMethods():
+  """Fills in Algorithms. Called by _InitializeUnboundMethods()."""
+  # Functions of the generated classes are only bound on first use.
+  for name in _generatedClasses:
+    _ImportGeneratedApi(globals()[name])
+
   # Sort the items by length, so parents get created before children.
   items = ApiFunction.unboundFunctions().items()
   items.sort(key=lambda x: len(x[0]))
@@ -328,9 +363,11 @@ def _InitializeUnboundMethods():
     target = Algorithms
     while len(name_parts) > 1:
       first = name_parts[0]
-      if not hasattr(target, first):
-        setattr(target, first, _AlgorithmsContainer())
-      target = getattr(target, first)
+      # Looked up with the dict methods, as Algorithms fills itself in on
+      # lookup.
+      if first not in target:
+        dict.__setitem__(target, first, _AlgorithmsContainer())
+      target = dict.__getitem__(target, first)
       name_parts = name_parts[1:]
 
     # Attach the function.
@@ -363,6 +400,50 @@ def _InitializeGeneratedClasses():
   types._registerClasses(globals())     # pylint: disable=protected-access
 
 
+class _GeneratedClassMeta(type(ComputedObject)):
+  """A meta-class that binds the API functions of a generated class on
+  first lookup of a missing attribute, rather than when it is created."""
+
+  def __getattr__(cls, attr):
+    if attr.startswith('__') or not _ImportGeneratedApi(cls):
+      raise AttributeError(attr)
+    # Not getattr(), which would come back here for unknown attributes.
+    return type.__getattribute__(cls, attr)
+
+
+def _ImportGeneratedApi(cls):
+  """Binds the API functions of a generated class on first use.
+
+  Args:
+    cls: The generated class.
+
+  Returns:
+    Whether the functions are bound. False while they are being bound, to
+    the lookups made by the binding itself.
+  """
+  if cls.__dict__.get('_apiImported'):
+    return True
+  with _bindLock:
+    if cls.__dict__.get('_apiImporting'):
+      return False
+    if not cls.__dict__.get('_apiImported'):
+      cls._apiImporting = True
+      try:
+        ApiFunction.importApi(cls, cls.__name__, cls.__name__)
+      finally:
+        del cls._apiImporting
+      # Only set once bound, other threads wait for the lock until then.
+      cls._apiImported = True
+  return True
+
+
+def _GeneratedInstanceGetattr(self, attr):
+  """Instance attribute fallback of the generated classes."""
+  if attr.startswith('__') or not _ImportGeneratedApi(type(self)):
+    raise AttributeError(attr)
+  return object.__getattribute__(self, attr)
+
+
 def _MakeClass(name):
   """Generates a dynamic API class for a given name."""
 
@@ -418,10 +499,9 @@ def _MakeClass(name):
         result = args[0]
       ComputedObject.__init__(self, result.func, result.args, result.varName)
 
-  properties = {'__init__': init, 'name': lambda self: name}
-  new_class = type(str(name), (ComputedObject,), properties)
-  ApiFunction.importApi(new_class, name, name)
-  return new_class
+  properties = {'__init__': init, 'name': lambda self: name,
+                '__getattr__': _GeneratedInstanceGetattr}
+  return _GeneratedClassMeta(str(name), (ComputedObject,), properties)
 
 
 # Set up type promotion rules as soon the package is loaded.
@@ -46,8 +46,9 @@ class ApiFunction(function.Function):
     if opt_signature is None:
       opt_signature = ApiFunction.lookup(name).getSignature()
 
-    # The signature of this API function.
-    self._signature = copy.deepcopy(opt_signature)
+    # The signature of this API function. Only the top level is copied, the
+    # argument descriptions are never modified and can be shared.
+    self._signature = copy.copy(opt_signature)
     self._signature['name'] = name
 
   def __eq__(self, other):
@@ -137,10 +138,15 @@ class ApiFunction(function.Function):
     return cls._api.get(name, None)
 
   @classmethod
-  def initialize(cls):
-    """Initializes the list of signatures from the Earth Engine front-end."""
+  def initialize(cls, opt_signatures=None):
+    """Initializes the list of signatures from the Earth Engine front-end.
+
+    Args:
+      opt_signatures: The signatures to use, as returned by
+          data.getAlgorithms(), instead of fetching them from the server.
+    """
     if not cls._api:
-      signatures = data.getAlgorithms()
+      signatures = opt_signatures or data.getAlgorithms()
       api = {}
       for name, sig in signatures.iteritems():
         # Strip type parameters.
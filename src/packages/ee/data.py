@@ -5,7 +5,10 @@
 # Using lowercase function naming to match the JavaScript names.
 # pylint: disable=g-bad-name
 
+import gzip
 import json
+import StringIO
+import threading
 import urllib
 
 import ee_exception
@@ -28,6 +31,21 @@ _initialized = False
 # it timed out. 0 means no limit.
 _deadline_ms = 0
 
+# The maximum number of calls a Batch runs at once.
+_batch_concurrency = 4
+
+# The maximum number of idle authorized HTTP clients kept for reuse.
+_pool_size = 4
+
+# Whether request bodies are sent gzipped.
+_compress_requests = False
+
+# Idle HTTP clients, all created with the credentials and timeout in
+# _http_pool_key. Each client is only used by one call at a time.
+_http_pool = []
+_http_pool_key = None
+_http_pool_lock = threading.Lock()
+
 # The default base URL for API calls.
 DEFAULT_API_BASE_URL = 'https://earthengine.googleapis.com/api'
 
@@ -73,6 +91,8 @@ def reset():
   _api_base_url = None
   _tile_base_url = None
   _initialized = False
+  with _http_pool_lock:
+    del _http_pool[:]
 
 
 def setDeadline(milliseconds):
@@ -86,6 +106,71 @@ def setDeadline(milliseconds):
   _deadline_ms = milliseconds
 
 
+def setPoolSize(size):
+  """Sets how many idle HTTP clients are kept for reuse between API calls.
+
+  Args:
+    size: The maximum number of idle clients. 0 disables reuse.
+  """
+  global _pool_size
+  _pool_size = size
+
+
+def setBatchConcurrency(concurrency):
+  """Sets the default maximum number of calls a Batch runs at once.
+
+  Args:
+    concurrency: The number of calls.
+  """
+  global _batch_concurrency
+  _batch_concurrency = concurrency
+
+
+def setCompression(enabled):
+  """Sets whether request bodies are gzipped.
+
+  Responses are always requested gzipped.
+
+  Args:
+    enabled: Whether to gzip request bodies.
+  """
+  global _compress_requests
+  _compress_requests = enabled
+
+
+def _acquireHttp():
+  """Returns an authorized HTTP client and the pool key it belongs to."""
+  global _http_pool_key
+  key = (_credentials, int(_deadline_ms / 1000) or None)
+  with _http_pool_lock:
+    if key != _http_pool_key:
+      # Credentials or deadline changed, the idle clients are stale.
+      del _http_pool[:]
+      _http_pool_key = key
+    if _http_pool:
+      return _http_pool.pop(), key
+  http = httplib2.Http(timeout=key[1])
+  if _credentials:
+    http = _credentials.authorize(http)
+  return http, key
+
+
+def _releaseHttp(http, key):
+  """Returns a client obtained from _acquireHttp() to the pool."""
+  with _http_pool_lock:
+    if key == _http_pool_key and len(_http_pool) < _pool_size:
+      _http_pool.append(http)
+
+
+def _gzip(data):
+  """Returns data gzip compressed."""
+  buf = StringIO.StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb')
+  f.write(data)
+  f.close()
+  return buf.getvalue()
+
+
 def getInfo(asset_id):
   """Load info for an asset, given an asset id.
 
@@ -441,6 +526,138 @@ def startProcessing(taskId, params):
   return send_('/processingrequest', args)
 
 
+class Future(object):
+  """The result of a call added to a Batch."""
+
+  def __init__(self, batch, func, args):
+    self._batch = batch
+    self._func = func
+    self._args = args
+    self._done = threading.Event()
+    self._value = None
+    self._error = None
+
+  def _run(self):
+    try:
+      self._value = self._func(*self._args)
+    except Exception, e:  # pylint: disable=broad-except
+      self._error = e
+    self._done.set()
+
+  def _wait(self):
+    # Another thread may be running the call in an execute() of its own.
+    self._batch.execute()
+    self._done.wait()
+
+  def done(self):
+    """Returns whether the call has run."""
+    return self._done.is_set()
+
+  def result(self):
+    """Returns the result of the call, running the batch if needed.
+
+    Raises:
+      The exception raised by the call, if any.
+    """
+    self._wait()
+    if self._error is not None:
+      raise self._error
+    return self._value
+
+  def exception(self):
+    """Returns the exception raised by the call or None, running the
+    batch if needed."""
+    self._wait()
+    return self._error
+
+
+class Batch(object):
+  """A set of API calls run concurrently.
+
+  Calls are added with the same arguments as the blocking functions of this
+  module and run on up to opt_concurrency threads when execute() is called
+  or the result of any of them is asked for. For example:
+
+    batch = ee.data.Batch()
+    values = [batch.getValue({'json': x.serialize()}) for x in objects]
+    mapid = batch.getMapId({'image': image.serialize()})
+    batch.execute()
+    print values[0].result(), mapid.result()
+  """
+
+  def __init__(self, opt_concurrency=None):
+    """Creates a batch.
+
+    Args:
+      opt_concurrency: The maximum number of calls to run at once. Defaults
+          to the value set by setBatchConcurrency().
+    """
+    self._concurrency = opt_concurrency or _batch_concurrency
+    self._futures = []
+    self._pending = []
+    self._lock = threading.Lock()
+
+  def add(self, func, *args):
+    """Adds a call of func with args to the batch.
+
+    Args:
+      func: The function to call, usually one of the functions of this
+          module, but any callable is accepted.
+      *args: The arguments to call it with.
+
+    Returns:
+      A Future for the result of the call.
+    """
+    future = Future(self, func, args)
+    with self._lock:
+      self._futures.append(future)
+      self._pending.append(future)
+    return future
+
+  def getValue(self, params):
+    """Adds a getValue() call. Returns its Future."""
+    return self.add(getValue, params)
+
+  def getMapId(self, params):
+    """Adds a getMapId() call. Returns its Future."""
+    return self.add(getMapId, params)
+
+  def getInfo(self, asset_id):
+    """Adds a getInfo() call. Returns its Future."""
+    return self.add(getInfo, asset_id)
+
+  def execute(self):
+    """Runs the calls that have not run yet and waits for them.
+
+    Returns:
+      The Futures of all the calls added to the batch, in the order they
+      were added.
+    """
+    # The lock only guards the pending list: the calls run without it so that
+    # they can add to and execute this batch themselves.
+    with self._lock:
+      pending = self._pending
+      self._pending = []
+    if pending:
+      queue = list(reversed(pending))
+
+      def Worker():
+        while True:
+          try:
+            future = queue.pop()
+          except IndexError:
+            return
+          future._run()  # pylint: disable=protected-access
+
+      threads = [threading.Thread(target=Worker)
+                 for _ in xrange(min(self._concurrency, len(pending)))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    return list(self._futures)
+
+
 def send_(path, params, opt_method='POST', opt_raw=False):
   """Send an API call.
 
@@ -462,26 +679,28 @@ def send_(path, params, opt_method='POST', opt_raw=False):
 
   url = _api_base_url + path
   payload = urllib.urlencode(params)
-  http = httplib2.Http(timeout=int(_deadline_ms / 1000) or None)
-
-  headers = {}
-  if _credentials:
-    http = _credentials.authorize(http)
 
+  headers = {'Accept-Encoding': 'gzip'}
   if opt_method == 'GET':
     url = url + '?' + payload
     payload = None
   elif opt_method == 'POST':
     headers['Content-type'] = 'application/x-www-form-urlencoded'
+    if _compress_requests:
+      headers['Content-Encoding'] = 'gzip'
+      payload = _gzip(payload)
   else:
     raise ee_exception.EEException('Unexpected request method: ' + opt_method)
 
+  http, key = _acquireHttp()
   try:
     response, content = http.request(url, method=opt_method, body=payload,
                                      headers=headers)
   except httplib2.HttpLib2Error, e:
+    # Do not reuse a client left in an unknown state.
     raise ee_exception.EEException(
         'Unexpected HTTP error: %s' % e.message)
+  _releaseHttp(http, key)
 
   if response.status != 200:
     raise ee_exception.EEException('Server returned HTTP code: %d' %
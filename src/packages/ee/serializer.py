@@ -8,7 +8,6 @@
 import datetime
 import json
 import math
-import md5
 import numbers
 
 import ee_exception
@@ -18,6 +17,14 @@ import encodable
 # The datetime for the beginning of the Unix epoch.
 _EPOCH_DATETIME = datetime.datetime.utcfromtimestamp(0)
 
+# Exact types that are encoded as is. Checking them first spares most values,
+# and every Encodable, the much slower isinstance() test against the
+# numbers.Number ABC.
+_PRIMITIVE_TYPES = frozenset([type(None), bool, int, long, float, str, unicode])
+
+# Writes the key a subtree is looked up by in Serializer._encoded.
+_KEY_ENCODER = json.JSONEncoder()
+
 
 def DatetimeToMicroseconds(date):
   """Convert a datetime to a timestamp, microseconds since the epoch."""
@@ -42,10 +49,10 @@ class Serializer(object):
     # A list of shared subtrees as [name, value] pairs.
     self._scope = []
 
-    # A lookup table from object hash to subtree names as stored in self._scope
+    # A lookup table from subtree key to subtree names as stored in self._scope
     self._encoded = {}
 
-    # A lookup table from object ID as retrieved by id() to md5 hash values.
+    # A lookup table from object ID as retrieved by id() to subtree keys.
     self._hashcache = {}
 
   def _encode(self, obj):
@@ -97,7 +104,9 @@ class Serializer(object):
           'type': 'ValueRef',
           'value': encoded
       }
-    elif obj is None or isinstance(obj, (bool, numbers.Number, basestring)):
+    elif (type(obj) in _PRIMITIVE_TYPES or
+          (not isinstance(obj, encodable.Encodable) and
+           isinstance(obj, (numbers.Number, basestring)))):
       # Primitives are encoded as is and not saved in the scope.
       return obj
     elif isinstance(obj, datetime.datetime):
@@ -131,7 +140,9 @@ class Serializer(object):
 
     if self._is_compound:
       # Save the new object and return a ValueRef.
-      hashval = md5.new(json.dumps(result)).digest()
+      # The children of result are already ValueRefs, so its JSON text is
+      # short and identifies the whole subtree. It is used as the key as is.
+      hashval = _KEY_ENCODER.encode(result)
       self._hashcache[obj_id] = hashval
       name = self._encoded.get(hashval, None)
       if not name:
@@ -0,0 +1,129 @@
+"""Test for the ee.data module."""
+
+
+
+import gzip
+import json
+import StringIO
+import threading
+import time
+
+import unittest
+
+import ee
+from ee import data
+
+
+class MockResponse(dict):
+  """An httplib2.Response stand-in."""
+
+  def __init__(self, status):
+    dict.__init__(self, status=status)
+    self.status = status
+
+
+class MockHttp(object):
+  """An httplib2.Http stand-in that records the requests it gets."""
+
+  instances = []
+
+  def __init__(self, timeout=None):
+    self.timeout = timeout
+    self.requests = []
+    MockHttp.instances.append(self)
+
+  def request(self, url, method, body, headers):
+    self.requests.append((url, method, body, headers))
+    return (MockResponse(200), json.dumps({'data': 'ok'}))
+
+
+class DataTest(unittest.TestCase):
+
+  def setUp(self):
+    ee.Reset()
+    MockHttp.instances = []
+    self.real_http = data.httplib2.Http
+    data.httplib2.Http = MockHttp
+
+  def tearDown(self):
+    data.httplib2.Http = self.real_http
+    data.setPoolSize(4)
+    data.setCompression(False)
+    ee.Reset()
+
+  def testClientReuse(self):
+    """Verifies that HTTP clients are reused between calls."""
+    self.assertEquals('ok', data.send_('/value', {'json': '1'}))
+    self.assertEquals('ok', data.send_('/value', {'json': '2'}))
+    self.assertEquals(1, len(MockHttp.instances))
+    self.assertEquals(2, len(MockHttp.instances[0].requests))
+
+    # A new deadline needs new clients.
+    data.setDeadline(5000)
+    data.send_('/value', {'json': '3'})
+    self.assertEquals(2, len(MockHttp.instances))
+    self.assertEquals(5, MockHttp.instances[1].timeout)
+    data.setDeadline(0)
+
+    data.setPoolSize(0)
+    data.send_('/value', {'json': '4'})
+    data.send_('/value', {'json': '5'})
+    self.assertEquals(4, len(MockHttp.instances))
+
+  def testCompression(self):
+    """Verifies that request bodies are gzipped when enabled."""
+    data.setCompression(True)
+    data.send_('/value', {'json': '1'})
+    unused_url, unused_method, body, headers = (
+        MockHttp.instances[0].requests[0])
+    self.assertEquals('gzip', headers['Content-Encoding'])
+    self.assertEquals('gzip', headers['Accept-Encoding'])
+    self.assertEquals('json=1',
+                      gzip.GzipFile(fileobj=StringIO.StringIO(body)).read())
+
+  def testBatch(self):
+    """Verifies that batched calls run concurrently and keep their order."""
+    lock = threading.Lock()
+    running = [0, 0]  # Current and maximum number of concurrent calls.
+
+    def Call(value):
+      with lock:
+        running[0] += 1
+        running[1] = max(running)
+      time.sleep(0.01)
+      with lock:
+        running[0] -= 1
+      if value == 3:
+        raise ee.EEException('failed %d' % value)
+      return value * 2
+
+    batch = data.Batch(opt_concurrency=2)
+    futures = [batch.add(Call, i) for i in range(6)]
+    self.assertFalse(futures[0].done())
+    self.assertEquals(futures, batch.execute())
+    self.assertEquals(2, running[1])
+    self.assertEquals(0, futures[0].result())
+    self.assertEquals(10, futures[5].result())
+    self.assertTrue('failed 3' in str(futures[3].exception()))
+    self.assertRaises(ee.EEException, futures[3].result)
+
+    # Calls added later run on the next execution.
+    future = batch.getValue({'json': '1'})
+    self.assertEquals('ok', future.result())
+    self.assertEquals(7, len(batch.execute()))
+
+  def testBatchNested(self):
+    """Verifies that a call can add to and run its own batch."""
+    batch = data.Batch(opt_concurrency=1)
+
+    def Call(value):
+      if value:
+        return batch.add(Call, value - 1).result() + value
+      return 0
+
+    self.assertEquals(6, batch.add(Call, 3).result())
+    self.assertEquals(4, len(batch.execute()))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,6 +2,8 @@
 
 
 
+import threading
+import time
 import unittest
 
 import ee
@@ -363,6 +365,84 @@ class EETestCase(apitestcase.ApiTestCase):
     self.assertEquals(ee.call('Foo.bar'), ee.Algorithms.Foo.bar())
     self.assertNotEquals(ee.Algorithms.Foo.bar(), ee.Algorithms.last())
 
+  def testLazyInitialization(self):
+    """Verifies given signatures are used and generated APIs bind lazily."""
+
+    def MockSend(path, params, unused_method=None, unused_raw=None):
+      raise Exception('Unexpected API call to %s with %s' % (path, params))
+    ee.data.send_ = MockSend
+
+    signatures = {
+        'Foo': {
+            'returns': 'Foo',
+            'args': [{'name': 'arg1', 'type': 'Object'}]
+        },
+        'Foo.makeFoo': {
+            'returns': 'Foo',
+            'args': [{'name': 'foo', 'type': 'Foo'}]
+        },
+        'bar': {
+            'returns': 'Object',
+            'args': []
+        }
+    }
+    ee.Initialize(None, opt_signatures=signatures)
+
+    self.assertFalse('makeFoo' in ee.Foo.__dict__)
+    self.assertFalse(ee._unboundMethodsInitialized)
+    foo = ee.Foo(1).makeFoo()
+    self.assertTrue(isinstance(foo, ee.Foo))
+    self.assertTrue('makeFoo' in ee.Foo.__dict__)
+    self.assertTrue(callable(ee.Algorithms.bar))
+    self.assertFalse(hasattr(ee.Foo, 'missing'))
+
+  def testConcurrentLazyInitialization(self):
+    """Verifies threads using a generated API first wait for its binding."""
+    ee.data.send_ = lambda *args: None
+    signatures = {
+        'Foo': {
+            'returns': 'Foo',
+            'args': [{'name': 'arg1', 'type': 'Object'}]
+        },
+        'Foo.makeFoo': {
+            'returns': 'Foo',
+            'args': [{'name': 'foo', 'type': 'Foo'}]
+        },
+        'bar': {
+            'returns': 'Object',
+            'args': []
+        }
+    }
+    ee.Initialize(None, opt_signatures=signatures)
+
+    # Slow the binding down so the other threads run into it.
+    original = ee.ApiFunction.__dict__['importApi']
+    import_api = ee.ApiFunction.importApi
+    def SlowImportApi(*args):
+      time.sleep(0.05)
+      import_api(*args)
+    ee.ApiFunction.importApi = staticmethod(SlowImportApi)
+
+    errors = []
+    start = threading.Event()
+    def Worker():
+      start.wait()
+      try:
+        ee.Foo(1).makeFoo()
+        ee.Algorithms.bar()
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+    threads = [threading.Thread(target=Worker) for _ in range(8)]
+    try:
+      for thread in threads:
+        thread.start()
+      start.set()
+      for thread in threads:
+        thread.join()
+    finally:
+      ee.ApiFunction.importApi = original
+    self.assertEquals([], errors)
+
   def testDatePromtion(self):
     # Make a feature, put a time in it, and get it out as a date.
     self.InitializeApi()
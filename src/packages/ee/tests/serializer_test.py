@@ -101,6 +101,19 @@ class SerializerTest(apitestcase.ApiTestCase):
     }
     self.assertEquals(expected1, json.loads(serializer.toJSON(test1)))
 
+  def testDistinctRepeats(self):
+    """Verifies equal subtrees from distinct objects are shared by type."""
+    # pylint: disable-msg=no-member
+    test = ee.Image(1).addBands(ee.Image(1)).addBands(
+        ee.Image(1.0).addBands(ee.Image(True)))
+    encoded = serializer.encode(test)
+    self.assertEquals(6, len(encoded['scope']))
+    constants = [value['arguments']['value'] for _, value in encoded['scope']
+                 if value['functionName'] == 'Image.constant']
+    self.assertEquals([1, 1.0, True], constants)
+    self.assertEquals(['float', 'bool'],
+                      [type(c).__name__ for c in constants[1:]])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -123,7 +123,7 @@ $(function() {
         ),
 
         initialize:function() {
-            _.bindAll(this, 'to_cell', 'start', 'select_mode', 'work_mode', 'change_report', 'compare_view', 'update_map_layers', 'cell_done', 'go_back', 'open_notes', 'change_cell', 'close_report', 'open_settings');
+            _.bindAll(this, 'to_cell', 'start', 'select_mode', 'work_mode', 'change_report', 'compare_view', 'update_map_layers', 'cell_done', 'go_back', 'open_notes', 'change_cell', 'close_report', 'open_settings', 'set_composite_panes');
 
             window.loading.loading("Imazon:initialize");
             this.reports = new ReportCollection();
@@ -470,6 +470,21 @@ $(function() {
                 });
                 this.compare_maps = [];
             }
+            this.set_composite_panes();
+        },
+
+        // every pane requests its EE layers as one composite tile
+        set_composite_panes: function() {
+            if(!this.gridstack) {
+                return;
+            }
+            var report_id = this.active_report.get('id');
+            var cell = this.gridstack.current_cell;
+            var panes = ['two', 'three', 'four'];
+            this.map.set_composite(report_id, cell, 'one');
+            _.each(this.compare_maps, function(m, i) {
+                m.set_composite(report_id, cell, panes[i]);
+            });
         },
 
         change_report: function() {
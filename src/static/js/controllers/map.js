@@ -224,10 +224,46 @@ var MapView = Backbone.View.extend({
     enable_layer: function(idx) {
     },
 
+    // EE tiles of the enabled xyz layers are requested blended in one tile
+    // from the composite url of the pane shown by this map. Pass no cell
+    // to request them one by one again
+    set_composite: function(report_id, cell, pane) {
+        if(cell) {
+            var cell_id = cell.get('z') + "_" + cell.get('x') + "_" + cell.get('y');
+            this.composite_url = "/ee/composite/" + report_id + "/" + cell_id + "/" + pane;
+        } else {
+            this.composite_url = undefined;
+        }
+        this.reoder_layers();
+    },
+
+    create_composite_layer: function(names) {
+        var url = this.composite_url;
+        return new google.maps.ImageMapType({
+            getTileUrl: function(tile, zoom) {
+                var y = tile.y;
+                var tileRange = 1 << zoom;
+                if (y < 0 || y  >= tileRange) {
+                  return null;
+                }
+                var x = tile.x;
+                if (x < 0 || x >= tileRange) {
+                  x = (x % tileRange + tileRange) % tileRange;
+                }
+                return url + "/" + zoom + "/" + x + "/" + y + "?layers=" + encodeURIComponent(names.join(','));
+            },
+            tileSize: new google.maps.Size(256, 256),
+            opacity: 1.0,
+            isPng: true
+        });
+    },
+
     // the next two functions are an EPIC PIECE OF SHIT
     reoder_layers: function() {
         var self = this;
         var idx = 0;
+        // names of the layers in the composite tile, bottom to top
+        var composite_names = [];
         self.map.overlayMapTypes.clear();
         var lyrs = self.layers.models;
         for(var i=0; i< lyrs.length; ++i) {
@@ -236,6 +272,19 @@ var MapView = Backbone.View.extend({
             var lyr;
             if(layer.get('type') === 'fake') {
                 //i'm very sorry
+            } else if(self.composite_url && layer.get('type') === 'xyz') {
+                layer.unbind('change', self.reoder_layers);
+                layer.bind('change', self.reoder_layers);
+                if(layer.enabled) {
+                    // the composite takes the place of the lowest one,
+                    // its tiles are requested once all names are known
+                    if(composite_names.length === 0) {
+                        self.map.overlayMapTypes.setAt(idx, self.create_composite_layer(composite_names));
+                        idx ++;
+                    }
+                    composite_names.push(layer.get('description'));
+                }
+                continue;
             } else if(layer.get('type') === 'google_maps') {
                 if(layer.enabled) {
                     var id = google.maps.MapTypeId[layer.get('map_id')];
@@ -4,7 +4,7 @@
 import unittest
 from datetime import date
 import simplejson as json
-from application.models import StatsStore, Report
+from application.models import StatsStore, StatsTable, Report
 from application.app import app
 from base import GoogleAuthMixin
 
@@ -83,6 +83,15 @@ class StatsTest(unittest.TestCase, GoogleAuthMixin):
         self.assertAlmostEquals(1, float(row1[3]))
         self.assertAlmostEquals(2, float(row1[4]))
 
+    def test_not_modified(self):
+        url = '/api/v0/stats/0000?reports=' + str(self.r.key().id())
+        rv = self.app.get(url)
+        etag = rv.headers.get('ETag')
+        self.assertTrue(etag)
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEquals(304, rv.status_code)
+        self.assertEquals('', rv.data)
+
     def test_non_existing(self):
         rv = self.app.get('/api/v0/stats/0002?reports=' + str(self.r.key().id()))
         self.assertEquals(404, rv.status_code)
@@ -91,6 +100,53 @@ class StatsTest(unittest.TestCase, GoogleAuthMixin):
         rv = self.app.get('/api/v0/stats/0000?reports=123123,' + str(self.r.key().id()))
         self.assertEquals(404, rv.status_code)
 
+    def test_report_without_stats(self):
+        r = Report(start=date(year=2011, month=3, day=1), finished=False)
+        r.put()
+        rv = self.app.get('/api/v0/stats/0000?reports=%s,%s' % (self.r.key().id(), r.key().id()))
+        self.assertEquals(404, rv.status_code)
+
+class StatsStoreTest(unittest.TestCase):
+    """ test stats stored by table """
+
+    def setUp(self):
+        for x in StatsStore.all():
+            x.delete()
+        self.report_id = 'report_key'
+        self.stats = {
+            'id': self.report_id,
+            'stats': {
+                '0000_01': {'id': '01', 'table': '0000', 'def': 1, 'deg': 2, 'total_area': 10},
+                '0000_02': {'id': '02', 'table': '0000', 'def': 3, 'deg': 4, 'total_area': 10},
+                '0001_02': {'id': '02', 'table': '0001', 'def': 5, 'deg': 6, 'total_area': 10}
+            }
+        }
+
+    def test_save_and_load(self):
+        StatsStore.save_for_report(self.report_id, self.stats)
+        t = StatsTable.for_report(self.report_id, '0000')
+        self.assertEquals(2, len(t.rows()))
+        self.assertEquals(3, t.row('02')['def'])
+        self.assertEquals([{'id': None, 'def': 4, 'deg': 6}], t.accum())
+        self.assertEquals([{'id': '01', 'def': 1, 'deg': 2}], t.accum('01'))
+        self.assertEquals(None, StatsTable.for_report(self.report_id, '0002'))
+        self.assertEquals(self.stats, StatsStore.get_for_report(self.report_id).as_dict())
+
+    def test_old_format(self):
+        StatsStore(report_id=self.report_id, json=json.dumps(self.stats)).put()
+        st = StatsStore.get_for_report(self.report_id)
+        self.assertEquals(1, len(st.for_table('0001')))
+        self.assertEquals(6, st.table_accum('0001')[0]['deg'])
+        StatsStore.save_for_report(self.report_id, st.as_dict())
+        self.assertEquals(1, StatsStore.all().count())
+
+    def test_missing_values(self):
+        self.stats['stats']['0000_03'] = {'id': '03', 'table': '0000', 'def': None, 'deg': None, 'total_area': None}
+        StatsStore.save_for_report(self.report_id, self.stats)
+        t = StatsTable.for_report(self.report_id, '0000')
+        self.assertEquals(None, t.row('03')['def'])
+        self.assertEquals([{'id': None, 'def': 4, 'deg': 6}], t.accum())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,21 +2,30 @@
 # encoding: utf-8
 
 import os
+import struct
+import time
+import zlib
 from datetime import datetime, timedelta, date
 import simplejson as json
 import flask
 import unittest
 import tempfile
+import threading
 
 from google.appengine.ext import testbed
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 from application.app import app
-from application.models import Area, Note, Cell, Report, User
-from application import models
+from application.models import Area, Note, Cell, CellWriter, FTSync, FustionTablesNames, Report, ReportChain, StatsRegionEdit, User
+from application import maps, models, settings
+from application.commands import is_throttled
 from application.resources.report import CellAPI
 from application.time_utils import timestamp
+from application.cache import LRUCache, SizedLRUCache, TwoTierCache
+from application.polygons import canonical_polygon, polygon_hash
+from application.tile_cache import composite
 
 from base import GoogleAuthMixin
 
@@ -33,6 +42,16 @@ class ReportTest(unittest.TestCase):
         self.assertEquals(1, datetime.fromtimestamp(r1[0]/1000).month)
         self.assertEquals(1, datetime.fromtimestamp(r1[0]/1000).day)
 
+    def test_chain_follows_writes(self):
+        self.assertEquals(None, self.r.previous_key())
+        later = Report(start=date(year=2011, month=3, day=1), finished=False)
+        later.put()
+        self.assertEquals(self.r.key(), later.previous_key())
+        self.r.close('asset')
+        self.assertEquals('asset', ReportChain.get().previous(later)[2])
+        self.r.delete()
+        self.assertEquals(None, later.previous_key())
+
 class CellTest(unittest.TestCase):
 
     def setUp(self):
@@ -45,6 +64,38 @@ class CellTest(unittest.TestCase):
     def test_parent_id(self):
         self.assertEquals('1_2_2', self.cell.parent_id)
 
+    def test_enabled_layers(self):
+        self.assertEquals(['NDFI analysis', 'Validated polygons'], self.cell.enabled_layers('one'))
+        self.assertEquals(['Terrain', 'LANDSAT/LE7_L1T'], self.cell.enabled_layers('four'))
+
+    def test_writer_puts_shared_parent_once(self):
+        user = users.User('test@gmail.com')
+        writer = CellWriter()
+        for x in xrange(5):
+            c = Cell.default_cell(self.r, x, 0, 1)
+            c.last_change_by = user
+            writer.add(c)
+        writer.commit()
+        q = Cell.all().filter('report =', self.r).filter('z =', 0)
+        self.assertEquals(1, q.count())
+        self.assertEquals(user, q.get().last_change_by)
+        self.assertEquals(5, Cell.all().filter('report =', self.r).filter('parent_id =', '0_0_0').count())
+
+    def test_counters(self):
+        r = Report(start=date.today(), finished=False, keyed_cells=True, cell_counters=True)
+        r.put()
+        cell = Cell.get_or_create(r, 1, 1, 1)
+        Note(msg='test', cell=cell).save()
+        cell.done = True
+        cell.put()
+        self.assertEquals(1, cell.as_dict()['note_count'])
+        self.assertEquals(1, r.cells_finished())
+        parent = Cell.get_cell(r, 0, 0, 0)
+        self.assertEquals(1, parent.as_dict()['children_done'])
+        cell.done = False
+        cell.put()
+        self.assertEquals(0, r.cells_finished())
+
 class NotesApiTest(unittest.TestCase, GoogleAuthMixin):
     def setUp(self):
         app.config['TESTING'] = True
@@ -237,6 +288,83 @@ class HomeTestCase(unittest.TestCase, GoogleAuthMixin):
 
 """
 
+def png(rgba):
+    """ 1x1 png of a (r, g, b, a) pixel """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 6, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress('\x00' + struct.pack('BBBB', *rgba))) +
+            chunk('IEND', ''))
+
+class DefaultMapsTest(unittest.TestCase):
+
+    def setUp(self):
+        memcache.flush_all()
+        self.r = Report(start=date.today(), finished=False)
+        self.r.put()
+        self.key = maps._cache_key(str(self.r.key()))
+        self.maps = [{'info': 'SMA', 'data': {'mapid': 'sma', 'token': 't'}}]
+
+    def test_expiring_maps_served_while_leased(self):
+        memcache.set(self.key, {'maps': self.maps, 'created': time.time() - settings.MAP_TOKEN_LIFETIME})
+        memcache.set(self.key + '_lease', 1)
+        self.assertEquals(self.maps, maps.get_default_maps(self.r))
+
+    def test_miss_waits_for_lease_holder(self):
+        memcache.set(self.key + '_lease', 1)
+        def store():
+            time.sleep(2 * maps.POLL_INTERVAL)
+            memcache.set(self.key, {'maps': self.maps, 'created': time.time()})
+        t = threading.Thread(target=store)
+        t.start()
+        self.assertEquals(self.maps, maps.get_default_maps(self.r))
+        t.join()
+
+
+class CompositeTileTest(unittest.TestCase, GoogleAuthMixin):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.login('test@gmail.com', 'testuser')
+        self.r = Report(start=date.today(), finished=False)
+        self.r.put()
+        layers = [('SMA', 'sma', (255, 0, 0, 255)), ('RGB', 'rgb', (0, 0, 255, 128))]
+        memcache.set(maps._cache_key(str(self.r.key())), {
+            'maps': [{'info': name, 'data': {'mapid': mapid, 'token': 't'}} for name, mapid, color in layers],
+            'created': time.time()
+        })
+        for name, mapid, color in layers:
+            memcache.set('%s/3/1/2' % mapid, {
+                'token': 't',
+                'status': 200,
+                'content': png(color),
+                'content_type': 'image/png',
+                'etag': '"%s"' % mapid
+            }, namespace='tiles')
+        self.url = '/ee/composite/%s/2_0_0/%%s/3/1/2' % self.r.key()
+
+    def test_composite(self):
+        rv = self.app.get(self.url % 'two' + '?layers=SMA,RGB')
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals('image/png', rv.headers['Content-Type'])
+        etag = rv.headers['ETag']
+        rv = self.app.get(self.url % 'two' + '?layers=SMA,RGB', headers={'If-None-Match': etag})
+        self.assertEquals(304, rv.status_code)
+        # the same layers in another order are another tile
+        rv = self.app.get(self.url % 'two' + '?layers=RGB,SMA')
+        self.assertNotEquals(etag, rv.headers['ETag'])
+
+    def test_unknown_layers(self):
+        self.assertEquals(404, self.app.get(self.url % 'five' + '?layers=SMA').status_code)
+        self.assertEquals(404, self.app.get(self.url % 'one' + '?layers=NDFI%20analysis').status_code)
+
+    def test_no_tiles(self):
+        missing = {'status': 404, 'content': '', 'content_type': 'text/html', 'etag': '""'}
+        self.assertEquals((None, None), composite([missing]))
+
+
 class FTTest(unittest.TestCase):
 
     def setUp(self):
@@ -262,6 +390,118 @@ class FTTest(unittest.TestCase):
 
 
 
+class FTSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        for x in FTSync.all():
+            x.delete()
+        self.r = Report(start=date.today(), finished=False)
+        self.r.put()
+        self.cell = Cell(x=0, y=0, z=2, report=self.r, ndfi_high=1.0, ndfi_low=0.0)
+        self.cell.put()
+        self.area = Area(geo='[]', type=1, cell=self.cell)
+        self.area.put()
+
+    def test_edits_collapse(self):
+        FTSync.enqueue(self.area)
+        FTSync.enqueue(self.area)
+        self.assertEquals(1, FTSync.all().count())
+        self.area.fusion_tables_id = 10
+        FTSync.enqueue(self.area, deleted=True)
+        self.assertEquals(1, FTSync.all().count())
+        change = FTSync.get_by_key_name(str(self.area.key()))
+        self.assertTrue(change.deleted)
+        self.assertEquals(10, change.fusion_tables_id)
+
+    def test_flush_stores_rowids_per_batch(self):
+        geo = '[[[-61.5,-12],[-61.5,-11],[-60.5,-11]]]'
+        areas = [Area(geo=geo, type=1, cell=self.cell) for _ in xrange(3)]
+        for a in areas:
+            a.put()
+            FTSync.enqueue(a)
+        client = FakeFT(fail_on_insert=2)
+        get_ft_client = Area._get_ft_client
+        insert_batch = FTSync.INSERT_BATCH
+        Area._get_ft_client = staticmethod(lambda: client)
+        FTSync.INSERT_BATCH = 2
+        try:
+            self.assertRaises(Exception, models.flush_fusion_tables)
+            # the first batch keeps its rowids when the second one fails
+            self.assertEquals([None, 101, 102], sorted(Area.get(a.key()).fusion_tables_id for a in areas))
+            client.fail_on_insert = None
+            models.flush_fusion_tables()
+        finally:
+            Area._get_ft_client = get_ft_client
+            FTSync.INSERT_BATCH = insert_batch
+        self.assertEquals([101, 102, 103], sorted(Area.get(a.key()).fusion_tables_id for a in areas))
+        self.assertEquals(3, client.inserts)
+        self.assertEquals(0, FTSync.all().count())
+
+
+class FakeFT(object):
+    """ fusion tables client answering inserts with consecutive rowids """
+
+    def __init__(self, fail_on_insert=None):
+        self.fail_on_insert = fail_on_insert
+        self.insert_calls = 0
+        self.inserts = 0
+
+    def table_id(self, name):
+        return 1
+
+    def sql(self, sql):
+        if not sql.startswith('insert'):
+            return ''
+        self.insert_calls += 1
+        if self.insert_calls == self.fail_on_insert:
+            raise Exception("fusion tables error")
+        count = sql.count('insert into')
+        rowids = [str(100 + self.inserts + i + 1) for i in xrange(count)]
+        self.inserts += count
+        return '\n'.join(['rowid'] + rowids) + '\n'
+
+
+class StatsRegionEditTest(unittest.TestCase):
+
+    def setUp(self):
+        for x in StatsRegionEdit.all():
+            x.delete()
+        self.r = Report(start=date.today(), finished=False)
+        self.r.put()
+        self.cell = Cell(x=0, y=0, z=2, report=self.r, ndfi_high=1.0, ndfi_low=0.0)
+        self.cell.put()
+
+    def test_edits_collapse(self):
+        first = '[[[-61.5,-12],[-61.5,-11],[-60.5,-11]]]'
+        moved = '[[[-51.5,-12],[-51.5,-11],[-50.5,-11]]]'
+        area = Area(geo=first, type=1, cell=self.cell)
+        area.save()
+        area.geo = moved
+        area.save()
+        edits = StatsRegionEdit.for_report(str(self.r.key()))
+        self.assertEquals(1, len(edits))
+        self.assertEquals(sorted([first, moved]), json.loads(edits[0].geos))
+        self.assertEquals(str(self.cell.key()), edits[0].cell)
+
+
+class FustionTablesNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        for x in FustionTablesNames.all():
+            x.delete()
+        FustionTablesNames.new_version()
+
+    def test_names_cached_until_new_version(self):
+        t = FustionTablesNames(table_id='1', json=json.dumps({'10': 'Altamira'}))
+        t.put()
+        self.assertEquals('Altamira', FustionTablesNames.names(1)['10'])
+        t.json = json.dumps({'10': 'Belem'})
+        t.put()
+        self.assertEquals('Altamira', FustionTablesNames.names(1)['10'])
+        FustionTablesNames.new_version()
+        self.assertEquals('Belem', FustionTablesNames.names(1)['10'])
+
+
 class CommandTest(unittest.TestCase, GoogleAuthMixin):
 
     def setUp(self):
@@ -279,6 +519,87 @@ class CommandTest(unittest.TestCase, GoogleAuthMixin):
         self.assertEquals(11, r.start.month)
         self.assertEquals(2010, r.start.year)
 
+    def test_is_throttled(self):
+        self.assertTrue(is_throttled(Exception('Server returned HTTP code: 429')))
+        self.assertTrue(is_throttled(Exception('Too many concurrent aggregations.')))
+        self.assertTrue(is_throttled(Exception('Quota exceeded for this user')))
+        self.assertFalse(is_throttled(Exception('Failed to generate image 4290503')))
+        self.assertFalse(is_throttled(Exception('Server returned HTTP code: 400')))
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(max_items=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEquals(1, c.get('a'))
+        c.set('c', 3)
+        self.assertEquals(None, c.get('b'))
+        self.assertEquals(1, c.get('a'))
+        self.assertEquals(3, c.get('c'))
+        c.delete('a')
+        self.assertEquals(1, len(c))
+
+    def test_evicts_by_size(self):
+        c = SizedLRUCache(max_bytes=6)
+        c.set('a', 'aaa')
+        c.set('b', 'bb')
+        c.set('c', 'ccc')
+        self.assertEquals(None, c.get('a'))
+        self.assertEquals(5, c.size)
+        c.set('big', 'x' * 7)
+        self.assertEquals(None, c.get('big'))
+        self.assertEquals('bb', c.get('b'))
+
+    def test_two_tier_get_multi(self):
+        memcache.flush_all()
+        c = TwoTierCache('test', max_bytes=6)
+        c.set('a', 'aaa')
+        memcache.set('b', 'bb', namespace='test')
+        self.assertEquals({'a': 'aaa', 'b': 'bb'}, c.get_multi(['a', 'b', 'c']))
+        self.assertEquals('bb', c.local.get('b'))
+        self.assertEquals(5, c.local.size)
+
+
+class PolygonTest(unittest.TestCase):
+
+    def test_canonical_polygon(self):
+        square = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
+        self.assertEquals([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)], canonical_polygon(square))
+        # clockwise, not closed, other start and below the precision
+        same = [(1, 1.0000001), (1, 0), (0, 0), (0, 1)]
+        self.assertEquals(canonical_polygon(square), canonical_polygon(same))
+        self.assertEquals(polygon_hash(square), polygon_hash(same))
+        self.assertNotEquals(polygon_hash(square), polygon_hash([(0, 0), (2, 0), (2, 2), (0, 2)]))
+
+
+class PolygonExportTest(unittest.TestCase, GoogleAuthMixin):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.login('test@gmail.com', 'testuser')
+        memcache.flush_all()
+        self.r = Report(start=date(year=2011, month=2, day=1),
+                        end=date(year=2011, month=3, day=1),
+                        finished=True, assetid='asset')
+        self.r.put()
+        self.polygon = [[-12, -61.5], [-11, -61.5], [-11, -60.5]]
+
+    def test_export_cached_stats(self):
+        ring = [(lng, lat) for lat, lng in self.polygon + self.polygon[:1]]
+        key = "%s_%s_aasset" % (polygon_hash(ring), self.r.key().id())
+        memcache.set(key, {'def': 1.5, 'deg': 2.5, 'total_area': 10}, namespace='polygon_stats')
+        rv = self.app.get('/api/v0/stats/polygon/csv', query_string={
+            'reports': str(self.r.key().id()),
+            'polygon': json.dumps(self.polygon)})
+        self.assertEquals(200, rv.status_code)
+        rows = rv.data.split('\r\n')
+        self.assertEquals('report_id,start_date,end_date,deforested,degraded', rows[0])
+        self.assertEquals(str(self.r.key().id()), rows[1].split(',')[0])
+        self.assertEquals(['1.5', '2.5'], rows[1].split(',')[-2:])
+
 if __name__ == '__main__':
     unittest.main()
 
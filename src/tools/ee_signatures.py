@@ -0,0 +1,44 @@
+#!/usr/bin/python
+"""
+Write the snapshot of the EE algorithm signatures shipped with the app, so
+instances do not fetch them from the EE server on cold start.
+
+usage: tools/ee_signatures.py SERVICE_ACCOUNT PRIVATE_KEY_FILE [API_URL]
+
+Run it from the src directory again whenever the EE library is updated.
+"""
+
+import gzip
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, 'packages')
+import ee
+
+SIGNATURES_DIR = os.path.join('application', 'ee_signatures')
+
+
+def main(account, key_file, api_url='https://earthengine.googleapis.com'):
+    credentials = ee.ServiceAccountCredentials(account, key_file)
+    ee.data.initialize(credentials, api_url + '/api', api_url)
+    signatures = ee.data.getAlgorithms()
+    if not os.path.isdir(SIGNATURES_DIR):
+        os.makedirs(SIGNATURES_DIR)
+    # the name ee_bridge.signatures_path looks for
+    host = re.sub('^https?://', '', api_url)
+    path = os.path.join(SIGNATURES_DIR, '%s-%s.json.gz' % (ee.__version__, host))
+    f = gzip.open(path, 'wb')
+    try:
+        f.write(json.dumps(signatures))
+    finally:
+        f.close()
+    print "%d signatures written to %s" % (len(signatures), path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print __doc__
+        sys.exit(1)
+    main(*sys.argv[1:])
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+"""
+Time ee.serializer on an expression graph shaped like the NDFI delta built
+by ee_bridge.NDFI._ndfi_delta: two kriged, unmixed MODIS mosaics feeding
+the NDFI of each period, which is then compared against a painted baseline.
+
+usage: tools/serializer_benchmark.py [PERIODS] [REPEAT]
+
+Run it from the src directory. No EE server is needed, the algorithms used
+are declared locally. PERIODS chains that many deltas, each one taking the
+previous result as its baseline, to show how the cost grows with the graph.
+"""
+
+import sys
+import time
+
+sys.path.insert(0, 'packages')
+import ee
+from ee import serializer
+
+# algorithm name -> number of arguments
+ALGORITHMS = {
+    'Image.load': 1, 'Image.constant': 1, 'Image.select': 3,
+    'Image.addBands': 2, 'Image.unmix': 2, 'Image.parseExpression': 3,
+    'Image.max': 2, 'Image.divide': 2, 'Image.add': 2, 'Image.subtract': 2,
+    'Image.multiply': 2, 'Image.byte': 1, 'Image.where': 3, 'Image.eq': 2,
+    'Image.neq': 2, 'Image.gt': 2, 'Image.lt': 2, 'Image.gte': 2,
+    'Image.and': 2, 'Image.not': 1, 'Image.connectedPixelCount': 2,
+    'Image.normalizedDifference': 1, 'Image.paint': 3,
+    'ImageCollection.load': 1, 'ImageCollection.mosaic': 1,
+    'Collection.loadTable': 1, 'Collection.filter': 2, 'Filter.equals': 2,
+    'Filter.dateRangeContains': 2, 'DateRange': 2, 'SAD.KrigeModis': 2,
+}
+
+BANDS = ['sur_refl_b0%d' % i for i in [3, 4, 1, 2, 6, 7]]
+ENDMEMBERS = [
+    [226.0,  710.0,  349.0, 5736.0, 2213.0,  520.0],
+    [838.0, 1576.0, 2527.0, 4305.0, 5885.0, 3760.0],
+    [696.0, 1235.0, 1841.0, 2763.0, 4443.0, 4232.0]
+]
+
+
+def signatures():
+    sigs = {}
+    for name, argc in ALGORITHMS.items():
+        returns = name.split('.')[0] if '.' in name else 'Object'
+        sigs[name] = {
+            'type': 'Algorithm',
+            'returns': returns,
+            'args': [{'name': 'arg%d' % i, 'type': 'Object'} for i in range(argc)],
+        }
+    return sigs
+
+
+def call(name, *args):
+    return ee.ApiFunction.call_(name, *args)
+
+
+def ndfi(start, end):
+    """ _NDFI_image over _unmixed_mosaic and _kriged_mosaic """
+    period = call('DateRange', start, end)
+    images = []
+    for collection in ('MOD09GA', 'MOD09GQ'):
+        c = call('ImageCollection.load', collection)
+        c = call('Collection.filter', c, call('Filter.dateRangeContains', period, 'system:time_start'))
+        images.append(call('ImageCollection.mosaic', c))
+    mosaic = call('Image.addBands', images[0], images[1])
+    params = call('Collection.filter', call('Collection.loadTable', 'kriging'),
+                  call('Filter.equals', 'Compounddate', start))
+    base = call('SAD.KrigeModis', mosaic, params)
+    unmixed = call('Image.unmix', call('Image.select', base, BANDS, BANDS), ENDMEMBERS)
+    unmixed = call('Image.select', unmixed, ['.*'], ['gv', 'soil', 'npv'])
+    clamped = call('Image.max', unmixed, 0)
+    summed = call('Image.parseExpression', 'b("gv") + b("soil") + b("npv")', 'b', [])
+    summed = call('Image.addBands', clamped, summed)
+    gv_shade = call('Image.divide', call('Image.select', clamped, ['gv'], ['gv']), summed)
+    npv_plus_soil = call('Image.add', call('Image.select', clamped, ['npv'], ['npv']),
+                         call('Image.select', clamped, ['soil'], ['soil']))
+    raw = call('Image.normalizedDifference', call('Image.addBands', gv_shade, npv_plus_soil))
+    result = call('Image.byte', call('Image.add', call('Image.multiply', raw, 100), 100))
+    result = call('Image.where', result, call('Image.eq', summed, 0), 201)
+    return call('Image.select', result, [0], ['ndfi'])
+
+
+def ndfi_delta(baseline, start, end):
+    """ the classification in _ndfi_delta """
+    ndfi0 = ndfi(start - 1000, start)
+    ndfi1 = ndfi(start, end)
+    diff = call('Image.subtract', ndfi1, ndfi0)
+    shifted_baseline = call('Image.add', baseline, 201)
+    result = call('Image.multiply', diff, -1)
+    result = call('Image.where', result, call('Image.gt', diff, 0), shifted_baseline)
+    result = call('Image.where', result, call('Image.lt', ndfi0, 100), 203)
+    segment_size = call('Image.connectedPixelCount', baseline, 41)
+    considered = call('Image.neq', baseline, 0)
+    for image, value in ((baseline, 1), (baseline, 2), (ndfi0, 201), (ndfi1, 201)):
+        considered = call('Image.and', considered, call('Image.neq', image, value))
+    considered = call('Image.and', considered, call('Image.gte', segment_size, 41))
+    result = call('Image.where', result, call('Image.not', considered), shifted_baseline)
+    cloud_size = call('Image.connectedPixelCount', call('Image.neq', ndfi1, 3), 21)
+    to_unclassify = call('Image.and', call('Image.and', call('Image.eq', baseline, 4),
+                                           call('Image.gte', segment_size, 41)),
+                         call('Image.lt', cloud_size, 21))
+    result = call('Image.where', result, to_unclassify, 204)
+    return call('Image.addBands', call('Image.byte', result), baseline)
+
+
+def main(periods=1, repeat=50):
+    ee.Initialize(None, '', signatures())
+    table = call('Collection.filter', call('Collection.loadTable', 'edited'),
+                 call('Filter.equals', 'type', 2))
+    graph = call('Image.paint', call('Image.load', 'PRODES_2009'), table, 1)
+    for i in range(periods):
+        graph = ndfi_delta(graph, 1000 * (i + 1), 1000 * (i + 1) + 500)
+
+    encoded = serializer.encode(graph)
+    start = time.time()
+    for _ in range(repeat):
+        json = serializer.toJSON(graph)
+    elapsed = (time.time() - start) / repeat
+    print "%d nodes, %d bytes: %.2f ms per serialization" % (
+        len(encoded['scope']), len(json), elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])